@@ -11,31 +11,48 @@ ARQUITECTURA HÍBRIDA:
 
 import os
 import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import logging
-import json
+import threading
 import httpx
+import orjson
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from types import MappingProxyType
+from typing import TYPE_CHECKING, List, Dict, Any, Callable, Mapping, Optional, Tuple
 from contextlib import asynccontextmanager
-import re
+from pathlib import Path
 import math
+import string
+import uuid
 
-from fastapi import FastAPI, HTTPException, Request, BackgroundTasks, Header
+from fastapi import FastAPI, HTTPException, Request, BackgroundTasks, Header, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
-# Importaciones de CrewAI
-from crewai import Agent, Task, Crew, Process
-from crewai.tools import BaseTool
-from crewai.knowledge.source.pdf_knowledge_source import PDFKnowledgeSource
 import yaml
 
+# CrewAI (y langchain detrás) es la importación más pesada del servicio: se importa
+# dentro de las funciones que lo usan, así cargar el módulo no paga ese coste
+if TYPE_CHECKING:
+    from crewai import Agent, Task
+    from crewai.knowledge.source.pdf_knowledge_source import PDFKnowledgeSource
+
+from src.services.informe_writer import InformeBatchWriter
+
+# Loader YAML em C (libyaml) quando disponível; senão, o SafeLoader puro Python
+try:
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
+
 # Cargar variables de entorno
 load_dotenv()
 
 # Configuración de logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Variables de entorno
@@ -49,6 +66,81 @@ BACKEND_URL = os.getenv("DOCUMENT_INGESTION_URL", "https://pipefy-document-inges
 # Cliente Supabase global
 supabase_client: Optional[Client] = None
 
+# Cliente HTTP asíncrono compartido para escribir directo en PostgREST (Supabase)
+supabase_http: Optional[httpx.AsyncClient] = None
+
+# Pool de hilos propio para las llamadas síncronas de supabase-py: no compiten
+# con la validación IA/clasificación en el executor por defecto de asyncio.
+# Se crea y se cierra en el lifespan (None fuera de él: se usa el executor por defecto)
+SUPABASE_EXECUTOR_WORKERS = int(os.getenv("SUPABASE_EXECUTOR_WORKERS", "4"))
+supabase_executor: Optional[ThreadPoolExecutor] = None
+
+def _resolve_crew_root() -> Path:
+    """
+    Localiza una sola vez el directorio del crew (knowledge/ y config/),
+    probando las raíces en orden: Render primero, luego entorno local.
+    """
+    base_dir = Path(__file__).resolve().parent
+    candidate_roots = [
+        Path("/opt/render/project/src/triagem_crew"),
+        Path("/opt/render/project/src"),
+        base_dir / "triagem_crew",
+        base_dir,
+    ]
+    return next(
+        (root for root in candidate_roots if (root / "knowledge" / "FAQ.pdf").exists()),
+        base_dir / "triagem_crew"
+    )
+
+# Rutas absolutas del crew, resueltas al importar el módulo (independientes del CWD)
+CREW_ROOT: Path = _resolve_crew_root()
+_faq_pdf_candidate = CREW_ROOT / "knowledge" / "FAQ.pdf"
+FAQ_PDF_PATH: Optional[Path] = _faq_pdf_candidate if _faq_pdf_candidate.exists() else None
+AGENTS_YAML_PATH: Path = CREW_ROOT / "config" / "agents.yaml"
+TASKS_YAML_PATH: Path = CREW_ROOT / "config" / "tasks.yaml"
+
+# Saída detalhada do CrewAI (cada passo do agente vai para stdout): desligada por padrão
+CREW_VERBOSE = os.getenv("CREW_VERBOSE", "False").lower() == "true"
+
+# Pré-aquecer os serviços de análise no startup (primeira request sem custo de arranque a frio)
+CREW_WARMUP = os.getenv("CREW_WARMUP", "True").lower() == "true"
+
+# Límite de análisis concurrentes contra el LLM (ajustar según rate limits de OpenAI)
+MAX_CONCURRENT_ANALYSES = int(os.getenv("MAX_CONCURRENT_ANALYSES", "4"))
+analysis_semaphore = asyncio.Semaphore(MAX_CONCURRENT_ANALYSES)
+
+# Backpressure: máximo de análisis esperando turno antes de responder 503 (0 = sin límite)
+MAX_QUEUED_ANALYSES = int(os.getenv("MAX_QUEUED_ANALYSES", "0"))
+analyses_running = 0
+analyses_waiting = 0
+
+# Pool de hilos dedicado al trabajo bloqueante del análisis (LLM, clasificación):
+# no agota el executor por defecto que usan los demás asyncio.to_thread del proceso.
+# Dos hilos por análisis en curso (validación y clasificación en paralelo).
+# Se crea y se cierra en el lifespan (None fuera de él: se usa el executor por defecto)
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", str(2 * MAX_CONCURRENT_ANALYSES)))
+analysis_executor: Optional[ThreadPoolExecutor] = None
+
+# Análisis en curso por clave de caché (coalescencia de requests idénticas)
+inflight_analyses: Dict[str, asyncio.Future] = {}
+
+# Inserts de informe_cadastro por lotes: hasta N filas o T segundos de acumulación
+INFORME_BATCH_SIZE = int(os.getenv("INFORME_BATCH_SIZE", "100"))
+INFORME_FLUSH_INTERVAL = float(os.getenv("INFORME_FLUSH_INTERVAL", "2.0"))
+
+# Análisis en segundo plano (job_id -> task) y tiempo de retención del resultado
+analysis_jobs: Dict[str, asyncio.Task] = {}
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "3600"))
+
+# Intervalo de eventos de progreso en /analyze/stream (mantiene viva la conexión ante proxies)
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "10"))
+
+# Fuente de conocimiento FAQ.pdf y agente de triagem: /analyze no usa crew, así que se
+# construyen bajo demanda la primera vez que se crea una tarea de triagem
+faq_knowledge_source: Optional["PDFKnowledgeSource"] = None
+triagem_agent: Optional["Agent"] = None
+_triagem_agent_lock = threading.Lock()
+
 # ============================================================================
 # HERRAMIENTAS SIMPLES QUE LLAMAN AL BACKEND
 # ============================================================================
@@ -62,7 +154,7 @@ supabase_client: Optional[Client] = None
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Gerencia o ciclo de vida da aplicação FastAPI."""
-    global supabase_client
+    global supabase_client, supabase_http, supabase_executor, analysis_executor
     
     # Startup
     logger.info("🤖 Iniciando Pipefy CrewAI Analysis Service v2.0 - HÍBRIDO INTELIGENTE...")
@@ -77,21 +169,58 @@ async def lifespan(app: FastAPI):
     
     try:
         supabase_client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+        supabase_http = httpx.AsyncClient(
+            base_url=f"{SUPABASE_URL.rstrip('/')}/rest/v1",
+            headers={
+                "apikey": SUPABASE_ANON_KEY,
+                "Authorization": f"Bearer {SUPABASE_ANON_KEY}"
+            },
+            timeout=30.0,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+        )
+        informe_writer.start()
         logger.info("✅ Cliente Supabase inicializado com sucesso.")
     except Exception as e:
         logger.error(f"ERRO ao inicializar cliente Supabase: {e}")
         raise RuntimeError(f"Falha na inicialização do Supabase: {e}")
     
+    # Pools de hilos por lifespan: un nuevo arranque en el mismo proceso no hereda pools cerrados
+    supabase_executor = ThreadPoolExecutor(max_workers=SUPABASE_EXECUTOR_WORKERS, thread_name_prefix="supabase")
+    analysis_executor = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix="analysis")
+    
+    # Precargar configuraciones YAML (quedan en caché para todas las requests)
+    load_agent_config()
+    load_task_config()
+    compile_task_description()
+    logger.info("✅ Configurações YAML do agente e das tarefas carregadas.")
+    
+    if CREW_WARMUP:
+        try:
+            await asyncio.to_thread(warmup_analysis_services)
+            logger.info("🔥 Serviços de análise pré-aquecidos.")
+        except Exception as e:
+            logger.error(f"ERRO ao pré-aquecer serviços de análise: {e}")
+    
     logger.info(f"🔗 Backend configurado en: {BACKEND_URL}")
-    logger.info("🎯 Agente de Triagem configurado com herramientas híbridas.")
     
     yield
     
     # Shutdown
     logger.info("INFO: Encerrando CrewAI Analysis Service...")
+    # Inserta los informes pendientes antes de cerrar el cliente HTTP
+    await informe_writer.stop()
+    if supabase_http:
+        await supabase_http.aclose()
+    # backend_http e ingestion_http son globales de módulo (sobreviven a un reinicio del
+    # lifespan): se cierran con atexit en sus módulos, no aquí
+    supabase_executor.shutdown(wait=False)
+    analysis_executor.shutdown(wait=False)
+    supabase_executor = None
+    analysis_executor = None
 
 app = FastAPI(
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
     title="Pipefy CrewAI Analysis Service v2.0 - Híbrido Inteligente",
     description="Servicio de análisis especializado que usa herramientas simples para llamar al backend"
 )
@@ -109,8 +238,10 @@ class DocumentInfo(BaseModel):
 class AnalysisRequest(BaseModel):
     case_id: str = Field(..., description="ID do case/card do Pipefy")
     documents: List[DocumentInfo] = Field(..., description="Lista de documentos para análise")
-    current_date: str = Field(default_factory=lambda: datetime.now().isoformat(), description="Data atual")
+    # Sem default_factory: o fluxo de /analyze não usa a data, então não se calcula datetime.now() por request
+    current_date: Optional[str] = Field(None, description="Data atual")
     pipe_id: Optional[str] = Field(None, description="ID do pipe do Pipefy")
+    cnpj: Optional[str] = Field(None, description="CNPJ da empresa (campo do card)")
 
 class AnalysisResponse(BaseModel):
     status: str
@@ -118,91 +249,94 @@ class AnalysisResponse(BaseModel):
     analysis_result: Any  # Permitir cualquier tipo para evitar errores de validación
     message: str
 
+# Saída estruturada da tarefa de triagem (mesmo esquema do expected_output em tasks.yaml):
+# o CrewAI valida a resposta do LLM contra o modelo, sem extração de JSON por regex
+class TriagemDocumento(BaseModel):
+    nome: str
+    status: str = Field(..., description="Conforme|Pendente|Ausente")
+    observacoes: str = ""
+
+class TriagemPendencia(BaseModel):
+    tipo: str = Field(..., description="Bloqueante|NaoBloqueante")
+    categoria: str
+    descricao: str
+    acao_requerida: str = ""
+    prazo_sugerido: str = ""
+
+class TriagemOutput(BaseModel):
+    case_id: str
+    status_geral: str = Field(..., description="Pendencia_Bloqueante|Pendencia_NaoBloqueante|Aprovado")
+    resumo_analise: str
+    documentos_analisados: List[TriagemDocumento] = []
+    pendencias: List[TriagemPendencia] = []
+    proximos_passos: List[str] = []
+    recomendacoes: str = ""
+    data_analise: Optional[str] = None
+    analista: str = "triagem_agent"
+
 # ============================================================================
 # CONFIGURACIÓN DEL AGENTE ENFOCADO
 # ============================================================================
 
-def create_faq_knowledge_source() -> PDFKnowledgeSource:
+def create_faq_knowledge_source() -> "PDFKnowledgeSource":
     """Cria a fonte de conhecimento baseada no FAQ.pdf"""
+    from crewai.knowledge.source.pdf_knowledge_source import PDFKnowledgeSource
     try:
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        logger.info(f"🏠 Directorio base: {base_dir}")
-        
-        # Detectar entorno y configurar path
-        render_knowledge_path = "/opt/render/project/src/knowledge/FAQ.pdf"
-        render_triagem_path = "/opt/render/project/src/triagem_crew/knowledge/FAQ.pdf"
-        
-        original_cwd = os.getcwd()
-        logger.info(f"🔄 Directorio de trabajo original: {original_cwd}")
-        
-        try:
-            if os.path.exists(render_knowledge_path):
-                os.chdir("/opt/render/project/src")
-                logger.info("🌐 Entorno Render - usando knowledge/")
-                faq_source = PDFKnowledgeSource(file_paths=["FAQ.pdf"])
-                logger.info("✅ FAQ.pdf cargado exitosamente")
-                return faq_source
-                
-            elif os.path.exists(render_triagem_path):
-                os.chdir("/opt/render/project/src/triagem_crew")
-                logger.info("🌐 Entorno Render - usando triagem_crew/knowledge/")
-                faq_source = PDFKnowledgeSource(file_paths=["FAQ.pdf"])
-                logger.info("✅ FAQ.pdf cargado exitosamente")
-                return faq_source
-            
-            # Entorno local
-            local_knowledge = os.path.join(base_dir, "knowledge", "FAQ.pdf")
-            local_triagem = os.path.join(base_dir, "triagem_crew", "knowledge", "FAQ.pdf")
-            
-            if os.path.exists(local_knowledge):
-                os.chdir(base_dir)
-                logger.info("🏠 Entorno local - usando knowledge/")
-                faq_source = PDFKnowledgeSource(file_paths=["FAQ.pdf"])
-                logger.info("✅ FAQ.pdf cargado exitosamente")
-                return faq_source
-                
-            elif os.path.exists(local_triagem):
-                triagem_dir = os.path.join(base_dir, "triagem_crew")
-                os.chdir(triagem_dir)
-                logger.info("🏠 Entorno local - usando triagem_crew/knowledge/")
-                faq_source = PDFKnowledgeSource(file_paths=["FAQ.pdf"])
-                logger.info("✅ FAQ.pdf cargado exitosamente")
-                return faq_source
-            
+        if FAQ_PDF_PATH is None:
             logger.error("❌ FAQ.pdf no encontrado en ninguna ubicación")
             raise FileNotFoundError("FAQ.pdf not found")
-            
-        finally:
-            os.chdir(original_cwd)
-            logger.info(f"🔄 Directorio restaurado a: {original_cwd}")
+        
+        # Reutiliza la fuente del FAQKnowledgeService (que solo recarga si cambia el hash del PDF),
+        # así el FAQ.pdf se procesa y embebe una única vez por proceso
+        from src.services.faq_knowledge_service import faq_knowledge_service
+        faq_source = faq_knowledge_service.get_knowledge_source()
+        if faq_source is None:
+            # Con un Path absoluto PDFKnowledgeSource no antepone 'knowledge/',
+            # así que no hace falta cambiar el directorio de trabajo (os.chdir es global al proceso)
+            faq_source = PDFKnowledgeSource(file_paths=[FAQ_PDF_PATH])
+        logger.info(f"✅ FAQ.pdf cargado exitosamente desde {FAQ_PDF_PATH}")
+        return faq_source
             
     except Exception as e:
         logger.error(f"❌ Erro ao criar fonte de conhecimento FAQ.pdf: {e}")
         raise
 
-def load_agent_config() -> Dict[str, Any]:
-    """Carrega a configuração do agente do arquivo YAML"""
+def get_faq_knowledge_source() -> "PDFKnowledgeSource":
+    """Retorna a fonte FAQ.pdf do processo, construindo-a só na primeira chamada"""
+    global faq_knowledge_source
+    if faq_knowledge_source is None:
+        faq_knowledge_source = create_faq_knowledge_source()
+    return faq_knowledge_source
+
+@functools.lru_cache(maxsize=8)
+def _load_yaml_config(path: Path, mtime_ns: int) -> Mapping[str, Any]:
+    """Parseia um YAML de configuração; em cache por (caminho, mtime), reparseia só se o arquivo mudar"""
+    with open(path, "rb") as file:
+        # Somente leitura: o dict fica em cache e é compartilhado entre requests
+        return MappingProxyType(yaml.load(file, Loader=YamlSafeLoader))
+
+def load_agent_config() -> Mapping[str, Any]:
+    """Carrega a configuração do agente do arquivo YAML (em cache enquanto o arquivo não mudar)"""
     try:
-        with open("triagem_crew/config/agents.yaml", "r", encoding="utf-8") as file:
-            return yaml.safe_load(file)
+        return _load_yaml_config(AGENTS_YAML_PATH, AGENTS_YAML_PATH.stat().st_mtime_ns)
     except Exception as e:
         logger.error(f"Erro ao carregar configuração do agente: {e}")
         raise
 
-def load_task_config() -> Dict[str, Any]:
-    """Carrega a configuração das tarefas do arquivo YAML"""
+def load_task_config() -> Mapping[str, Any]:
+    """Carrega a configuração das tarefas do arquivo YAML (em cache enquanto o arquivo não mudar)"""
     try:
-        with open("triagem_crew/config/tasks.yaml", "r", encoding="utf-8") as file:
-            return yaml.safe_load(file)
+        return _load_yaml_config(TASKS_YAML_PATH, TASKS_YAML_PATH.stat().st_mtime_ns)
     except Exception as e:
         logger.error(f"Erro ao carregar configuração das tarefas: {e}")
         raise
 
-def create_triagem_agent() -> Agent:
+def create_triagem_agent() -> "Agent":
     """Cria o agente de triagem com herramientas híbridas simples"""
+    from crewai import Agent
     try:
         agent_config = load_agent_config()
-        faq_source = create_faq_knowledge_source()
+        faq_source = get_faq_knowledge_source()
         
         # Herramientas simples que llaman al backend
         from src.tools.backend_api_tools import BACKEND_API_TOOLS
@@ -214,157 +348,467 @@ def create_triagem_agent() -> Agent:
             backstory=agent_config["triagem_agent"]["backstory"],
             tools=tools,
             knowledge_sources=[faq_source],
-            verbose=True,
+            verbose=CREW_VERBOSE,
             allow_delegation=False
         )
     except Exception as e:
         logger.error(f"Erro ao criar agente de triagem: {e}")
         raise
 
-def create_triagem_task_from_inputs(inputs: Dict[str, Any], agent: Agent) -> Task:
-    """Cria a tarefa de triagem baseada nos inputs"""
+def get_triagem_agent() -> "Agent":
+    """
+    Retorna o agente de triagem do processo.
+    Constrói na primeira chamada (FAQ.pdf + LLM) e guarda para as seguintes.
+    """
+    global triagem_agent
+    if triagem_agent is None:
+        # Tasks podem ser criadas de várias threads: só uma constrói o agente
+        with _triagem_agent_lock:
+            if triagem_agent is None:
+                triagem_agent = create_triagem_agent()
+    return triagem_agent
+
+@functools.lru_cache(maxsize=4)
+def _split_template(template: str) -> Tuple[Tuple[str, Optional[str]], ...]:
+    return tuple((literal, field) for literal, field, _, _ in string.Formatter().parse(template))
+
+def compile_task_description() -> Tuple[Tuple[str, Optional[str]], ...]:
+    """Pré-divide o template da descrição da tarefa em pares (literal, campo), uma vez por versão do YAML"""
+    return _split_template(load_task_config()["triagem_task"]["description"])
+
+def render_task_description(inputs: Dict[str, Any]) -> str:
+    """
+    Renderiza a descrição da tarefa a partir do template pré-dividido.
+    Campos ausentes em inputs (ex.: current_date opcional) ficam como '{campo}', sem KeyError.
+    """
+    return "".join(
+        literal if field is None
+        else literal + (str(inputs[field]) if field in inputs else "{" + field + "}")
+        for literal, field in compile_task_description()
+    )
+
+def create_triagem_task_from_inputs(inputs: Dict[str, Any], agent: Optional["Agent"] = None) -> "Task":
+    """
+    Cria a tarefa de triagem baseada nos inputs.
+    Sem agente explícito, reutiliza o agente compartilhado (criado na primeira tarefa): por request só se cria a Task.
+    """
+    from crewai import Task
     try:
         task_config = load_task_config()
         
         return Task(
-            description=task_config["triagem_task"]["description"].format(**inputs),
+            description=render_task_description(inputs),
             expected_output=task_config["triagem_task"]["expected_output"],
-            agent=agent
+            agent=agent or get_triagem_agent(),
+            output_pydantic=TriagemOutput
         )
     except Exception as e:
         logger.error(f"Erro ao criar tarefa de triagem: {e}")
         raise
 
+def warmup_analysis_services() -> None:
+    """
+    Importa e inicializa os serviços usados por /analyze (checklist JSON, regras do FAQ).
+    Sem isto a primeira request pagaria os imports pesados e a carga do FAQ.pdf.
+    Também abre a conexão keep-alive com o backend usada pelas ferramentas do agente.
+    """
+    from src.services.faq_knowledge_service import faq_knowledge_service
+    from src.services.classification_service import classification_service
+    from src.tools.backend_api_tools import backend_http
+    faq_knowledge_service.load_checklist()
+    faq_knowledge_service.get_knowledge_source()
+    try:
+        # Handshake TCP+TLS feito agora, não na primeira chamada de ferramenta
+        backend_http.get("/health", timeout=5.0)
+    except httpx.HTTPError as e:
+        logger.warning(f"⚠️ Backend indisponível no pré-aquecimento: {e}")
+
+async def save_informes(informes: List[Dict[str, Any]]) -> httpx.Response:
+    """Inserta un lote de informes en Supabase vía PostgREST (un único POST con array JSON)"""
+    response = await supabase_http.post(
+        "/informe_cadastro",
+        content=orjson.dumps(informes),
+        # return=minimal: PostgREST no devuelve la fila insertada (el cuerpo nunca se lee)
+        headers={"Content-Type": "application/json", "Prefer": "return=minimal"}
+    )
+    response.raise_for_status()
+    return response
+
+# Writer por lotes de informe_cadastro (se arranca/detiene en el lifespan)
+informe_writer = InformeBatchWriter(
+    save_informes,
+    batch_size=INFORME_BATCH_SIZE,
+    flush_interval=INFORME_FLUSH_INTERVAL
+)
+
 # ============================================================================
 # ENDPOINTS PRINCIPALES
 # ============================================================================
 
-@app.post("/analyze", response_model=AnalysisResponse)
-async def analyze_documents(request: AnalysisRequest) -> AnalysisResponse:
+@asynccontextmanager
+async def analysis_slot():
     """
-    Endpoint principal para análisis de documentos.
-    Ahora analiza el campo 'parsed_content' de cada documento, no la URL.
+    Turno de un análisis en el semáforo (uno por análisis), con contadores para /health.
+    Si la cola supera MAX_QUEUED_ANALYSES se rechaza con 503 en vez de esperar indefinidamente;
+    se entra una sola vez por análisis, antes de empezar, así que un análisis admitido no se rechaza después.
     """
+    global analyses_running, analyses_waiting
+    if MAX_QUEUED_ANALYSES and analysis_semaphore.locked() and analyses_waiting >= MAX_QUEUED_ANALYSES:
+        raise HTTPException(status_code=503, detail="Servicio saturado: demasiados análisis en cola, reintente más tarde")
+    analyses_waiting += 1
     try:
-        logger.info(f"🔍 Iniciando análisis para case_id: {request.case_id}")
-        # Validar que todos los documentos tengan parsed_content
-        for doc in request.documents:
-            if not getattr(doc, 'parsed_content', None):
-                raise HTTPException(status_code=400, detail=f"El documento '{doc.name}' no tiene contenido parseado ('parsed_content')")
-        # Validación estructurada híbrida (checklist JSON)
-        documentos_input = [doc.dict() for doc in request.documents]
-        from src.services.faq_knowledge_service import faq_knowledge_service
-        validacion = faq_knowledge_service.validate_documents(documentos_input)
-        logger.info(f"📝 Resultado validación estructurada: {validacion['status']}")
+        await analysis_semaphore.acquire()
+    finally:
+        analyses_waiting -= 1
+    analyses_running += 1
+    try:
+        yield
+    finally:
+        analyses_running -= 1
+        analysis_semaphore.release()
+
+def is_cacheable_analysis(validacion: Dict[str, Any], result: Any) -> bool:
+    """
+    Solo se cachean análisis completos: sin errores del LLM en la validación (o checklist
+    no disponible) ni enriquecimiento del Cartão CNPJ fallido, para que un reintento los repita.
+    """
+    if validacion.get("status") == "error" or validacion.get("llm_errors"):
+        return False
+    return not any(
+        (action.get("enrich_result") or {}).get("success") is False
+        for action in result.auto_actions
+    )
+
+async def compute_analysis(
+    request: AnalysisRequest,
+    documentos_input: List[Dict[str, Any]],
+    on_checklist: Optional[Callable[[Dict[str, Any]], Any]] = None
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Validación IA del checklist, clasificación y persistencia del informe.
+    Retorna (analysis_result que se envía al cliente, si el resultado puede cachearse).
+    on_checklist (opcional) recibe el resultado de la validación en cuanto está listo,
+    sin esperar a la clasificación (usado por /analyze/ndjson).
+    """
+    from src.services.faq_knowledge_service import faq_knowledge_service
+    from src.services.classification_service import classification_service
+    loop = asyncio.get_running_loop()
+    # cnpj del card: campo explícito del request
+    card_data = {"cnpj": request.cnpj} if request.cnpj else {}
+    # Reutiliza los dicts ya serializados en run_analysis (un solo dump por documento)
+    documents_by_tag = {doc["document_tag"]: doc for doc in documentos_input}
+
+    # Si la validación falla antes de que arranque el hilo de la clasificación, esta se omite
+    # (no se llama al backend de ingestion para un análisis que ya falló)
+    omitir_clasificacion = threading.Event()
+
+    def clasificar() -> Any:
+        if omitir_clasificacion.is_set():
+            return None
+        return classification_service.classify_documents(documents_by_tag, card_data, request.case_id)
+
+    # Un único turno del semáforo por análisis, tomado antes de empezar: la admisión (503)
+    # se decide una sola vez y la clasificación (sin LLM) no consume un turno propio.
+    # Validación IA del checklist y clasificación son independientes: se ejecutan en paralelo
+    # en el pool de análisis (llamadas bloqueantes: LLM y httpx síncrono, fuera del event loop)
+    async with analysis_slot():
+        validacion_futuro = loop.run_in_executor(
+            analysis_executor, faq_knowledge_service.validate_documents, documentos_input
+        )
+        clasificacion = loop.run_in_executor(analysis_executor, clasificar)
+        try:
+            validacion = await validacion_futuro
+        except BaseException:
+            omitir_clasificacion.set()
+            # Un hilo ya en marcha no se puede interrumpir: se espera a que termine
+            # (descartando su resultado) con el turno del análisis aún ocupado
+            await asyncio.wait({clasificacion})
+            if not clasificacion.cancelled():
+                clasificacion.exception()
+            raise
+        if on_checklist is not None:
+            on_checklist(validacion)
+        result = await clasificacion
+    # Detalle del checklist solo en DEBUG; en INFO una única línea de resumen por análisis
+    if logger.isEnabledFor(logging.DEBUG):
         for log in validacion["logs"]:
-            logger.info(f"[CHECKLIST] {log}")
-        if validacion.get("acciones_automaticas"):
-            for accion in validacion["acciones_automaticas"]:
-                logger.info(f"[ACCION_AUTOMATICA] {accion}")
-        # Preparar inputs para el agente
-        inputs = {
+            logger.debug("[CHECKLIST] %s", log)
+        for accion in validacion.get("acciones_automaticas") or ():
+            logger.debug("[ACCION_AUTOMATICA] %s", accion)
+    # Sanear risk_score antes de guardar
+    try:
+        risk_score = float(result.confidence_score)
+    except (TypeError, ValueError):
+        risk_score = math.nan
+    # Una sola comparación encadenada: NaN también falla (toda comparación con NaN es False)
+    if not 0.0 <= risk_score <= 1.0:
+        logger.warning("⚠️ risk_score inválido detectado (%s), se asigna 0.0", result.confidence_score)
+        risk_score = 0.0
+    # Validar tipos de los demás campos
+    try:
+        documents_analyzed = int(len(request.documents))
+    except Exception:
+        documents_analyzed = 0
+    informe = str(result.summary) if result.summary is not None else ""
+    analysis_details = str(result.classification_type.value) if result.classification_type else ""
+    analysis_result = {
+        "informe": informe,
+        "structured_response": analysis_details,
+        "risk_score": risk_score,
+        "documents_analyzed": documents_analyzed,
+        "checklist_logs": validacion["logs"],
+        "acciones_automaticas": validacion.get("acciones_automaticas", [])
+    }
+    # Guardar en Supabase (tabla informe_cadastro)
+    try:
+        informe_data = {
             "case_id": request.case_id,
-            "documents": documentos_input,
-            "current_date": request.current_date,
-            "pipe_id": request.pipe_id or "default"
-        }
-        # Extraer cnpj del card (siempre disponible)
-        cnpj_value = None
-        if hasattr(request, 'cnpj'):
-            cnpj_value = request.cnpj
-        else:
-            for doc in request.documents:
-                if hasattr(doc, 'cnpj'):
-                    cnpj_value = doc.cnpj
-                    break
-        card_data = {"cnpj": cnpj_value} if cnpj_value else {}
-        documents_by_tag = {doc.document_tag: doc.dict() for doc in request.documents}
-        # Llamar al servicio de clasificación robusto (IA)
-        from src.services.classification_service import classification_service
-        result = classification_service.classify_documents(documents_by_tag, card_data, request.case_id)
-        logger.info(f"✅ Análisis completado para case_id: {request.case_id}")
-        # Sanear risk_score antes de guardar
-        risk_score = result.confidence_score
-        if risk_score is None or not isinstance(risk_score, (int, float)) or math.isnan(risk_score) or risk_score < 0 or risk_score > 1:
-            logger.warning(f"⚠️ risk_score inválido detectado ({risk_score}), se asigna 0.0")
-            risk_score = 0.0
-        else:
-            logger.info(f"✅ risk_score válido: {risk_score}")
-        # Validar tipos de los demás campos
-        try:
-            documents_analyzed = int(len(request.documents))
-        except Exception:
-            documents_analyzed = 0
-        informe = str(result.summary) if result.summary is not None else ""
-        analysis_details = str(result.classification_type.value) if result.classification_type else ""
-        analysis_result = {
             "informe": informe,
-            "structured_response": analysis_details,
             "risk_score": risk_score,
             "documents_analyzed": documents_analyzed,
-            "checklist_logs": validacion["logs"],
-            "acciones_automaticas": validacion.get("acciones_automaticas", [])
+            "analysis_details": analysis_details
         }
-        # Guardar en Supabase (tabla informe_cadastro)
-        try:
-            informe_data = {
-                "case_id": request.case_id,
-                "informe": informe,
-                "risk_score": float(risk_score),
-                "documents_analyzed": documents_analyzed,
-                "analysis_details": analysis_details
-            }
-            logger.info(f"[SUPABASE] Insertando informe: {informe_data}")
-            response = supabase_client.table("informe_cadastro").insert(informe_data).execute()
-            logger.info(f"[SUPABASE] Respuesta: {response}")
-            logger.info(f"💾 Informe guardado en Supabase tabla informe_cadastro para case_id: {request.case_id}")
-        except Exception as e:
-            logger.error(f"❌ Error guardando informe en Supabase: {e}")
-            logger.error("Sugerencia: Revisa la definición de la tabla 'informe_cadastro' en Supabase Studio y prueba un insert manual con los mismos datos para depurar el constraint.")
-        return AnalysisResponse(
-            status="completed",
-            case_id=request.case_id,
-            analysis_result=analysis_result,
-            message="Análisis completado exitosamente"
-        )
+        # El repr del informe completo solo se construye si DEBUG está activo
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[SUPABASE] Encolando informe: %s", informe_data)
+        # Se inserta en el próximo lote (errores de insert se registran en el writer)
+        await informe_writer.enqueue(informe_data)
     except Exception as e:
-        logger.error(f"❌ Error en análisis para case_id {request.case_id}: {e}")
+        logger.error("❌ Error encolando informe para Supabase: %s", e)
+    logger.info(
+        "✅ Análisis completado para case_id: %s (validación: %s, informe encolado)",
+        request.case_id, validacion["status"]
+    )
+    return analysis_result, is_cacheable_analysis(validacion, result)
+
+def build_analysis_response(case_id: str, analysis_result: Dict[str, Any]) -> Dict[str, Any]:
+    """Cuerpo de respuesta de un análisis completado (mismo esquema que AnalysisResponse)"""
+    return {
+        "status": "completed",
+        "case_id": case_id,
+        "analysis_result": analysis_result,
+        "message": "Análisis completado exitosamente"
+    }
+
+async def run_analysis(
+    request: AnalysisRequest,
+    on_checklist: Optional[Callable[[Dict[str, Any]], Any]] = None
+) -> Dict[str, Any]:
+    """
+    Ejecuta el análisis completo de un caso.
+    Compartido por el endpoint síncrono y por los jobs en segundo plano.
+    Retorna un dict plano con el esquema de AnalysisResponse, listo para serializar.
+    on_checklist solo se invoca si este request arranca el análisis (no en caché ni en curso).
+    """
+    try:
+        logger.info("🔍 Iniciando análisis para case_id: %s", request.case_id)
+        # Validar que todos los documentos tengan parsed_content (Pydantic ya garantiza el campo;
+        # aquí solo se rechaza el texto vacío, parando en el primer documento sin contenido)
+        doc_sin_contenido = next((doc for doc in request.documents if not doc.parsed_content), None)
+        if doc_sin_contenido is not None:
+            raise HTTPException(status_code=400, detail=f"El documento '{doc_sin_contenido.name}' no tiene contenido parseado ('parsed_content')")
+        # Validación estructurada híbrida (checklist JSON)
+        # Un único model_dump (pydantic-core) en vez de .dict() documento a documento
+        documentos_input = request.model_dump(include={"documents"})["documents"]
+        # Caché de resultados: el mismo caso con los mismos documentos no se re-analiza
+        from src.services.analysis_cache import analysis_cache
+        cache_key = analysis_cache.build_key(request.case_id, request.pipe_id, documentos_input, request.cnpj)
+        cached_result = analysis_cache.get(cache_key)
+        if cached_result is not None:
+            logger.info("⚡ Resultado servido desde caché para case_id: %s", request.case_id)
+            return build_analysis_response(request.case_id, cached_result)
+        # Requests idénticas concurrentes comparten un único análisis en curso
+        inflight = inflight_analyses.get(cache_key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(compute_analysis(request, documentos_input, on_checklist))
+            inflight_analyses[cache_key] = inflight
+            inflight.add_done_callback(lambda _: inflight_analyses.pop(cache_key, None))
+        else:
+            logger.info("🔗 Análisis idéntico en curso para case_id: %s, reutilizando resultado", request.case_id)
+        analysis_result, cacheable = await asyncio.shield(inflight)
+        if cacheable:
+            analysis_cache.set(cache_key, analysis_result)
+        else:
+            logger.info("♻️ Análisis incompleto para case_id: %s, no se cachea", request.case_id)
+        return build_analysis_response(request.case_id, analysis_result)
+    except HTTPException:
+        # Errores de validación (400) se propagan tal cual, sin re-envolver como 500
+        raise
+    except Exception as e:
+        logger.error("❌ Error en análisis para case_id %s: %s", request.case_id, e)
         raise HTTPException(
             status_code=500,
             detail=f"Error en análisis para case_id {request.case_id}: {str(e)}"
         )
 
+@app.post("/analyze", response_model=AnalysisResponse)
+async def analyze_documents(request: AnalysisRequest) -> ORJSONResponse:
+    """
+    Endpoint principal para análisis de documentos.
+    Ahora analiza el campo 'parsed_content' de cada documento, no la URL.
+    """
+    # El dict ya tiene el esquema de AnalysisResponse: se serializa directo, sin re-validar
+    return ORJSONResponse(await run_analysis(request))
+
+@app.post("/analyze/async", status_code=202)
+async def enqueue_analysis(request: AnalysisRequest) -> Dict[str, Any]:
+    """
+    Encola el análisis en segundo plano y responde inmediatamente con un job_id.
+    El resultado se consulta en GET /analyze/{job_id}.
+    """
+    job_id = uuid.uuid4().hex
+    task = asyncio.create_task(run_analysis(request))
+    analysis_jobs[job_id] = task
+    # Liberar el resultado pasado el tiempo de retención
+    task.add_done_callback(
+        lambda _: asyncio.get_running_loop().call_later(JOB_RESULT_TTL, analysis_jobs.pop, job_id, None)
+    )
+    logger.info(f"📥 Análisis encolado para case_id: {request.case_id} (job_id: {job_id})")
+    return {"status": "queued", "job_id": job_id, "case_id": request.case_id}
+
+def format_sse(event: str, data: Any) -> bytes:
+    """Serializa un evento Server-Sent Events con el payload en JSON (orjson)"""
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+@app.post("/analyze/stream")
+async def analyze_documents_stream(request: AnalysisRequest) -> StreamingResponse:
+    """
+    Análisis con respuesta en streaming (SSE).
+    Emite 'progress' mientras el análisis está en curso y 'result' (o 'error') al terminar,
+    así el cliente y los proxies no cortan la conexión durante análisis largos.
+    """
+    async def event_stream():
+        task = asyncio.ensure_future(run_analysis(request))
+        try:
+            yield format_sse("progress", {"status": "processing", "case_id": request.case_id})
+            while not task.done():
+                await asyncio.wait({task}, timeout=SSE_HEARTBEAT_SECONDS)
+                if not task.done():
+                    yield format_sse("progress", {"status": "processing", "case_id": request.case_id})
+            error = task.exception()
+            if error is None:
+                yield format_sse("result", task.result())
+            else:
+                detail = error.detail if isinstance(error, HTTPException) else str(error)
+                status_code = error.status_code if isinstance(error, HTTPException) else 500
+                yield format_sse("error", {"status": "error", "case_id": request.case_id, "status_code": status_code, "message": detail})
+        finally:
+            # Cliente desconectado: el análisis compartido sigue (shield) y queda en caché
+            if not task.done():
+                task.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def format_ndjson(stage: str, data: Any) -> bytes:
+    """Serializa una línea NDJSON {"stage": ..., "data": ...} (orjson)"""
+    return orjson.dumps({"stage": stage, "data": data}) + b"\n"
+
+@app.post("/analyze/ndjson")
+async def analyze_documents_ndjson(request: AnalysisRequest) -> StreamingResponse:
+    """
+    Análisis por etapas en streaming (NDJSON).
+    Emite 'checklist' con la validación en cuanto termina, mientras la clasificación sigue,
+    y 'classification' con la respuesta completa (esquema de /analyze) o 'error' al final.
+    Resultados servidos desde caché o de un análisis idéntico en curso solo emiten la etapa final.
+    """
+    async def stage_stream():
+        checklist = asyncio.get_running_loop().create_future()
+        task = asyncio.ensure_future(run_analysis(request, on_checklist=checklist.set_result))
+        try:
+            await asyncio.wait({task, checklist}, return_when=asyncio.FIRST_COMPLETED)
+            if checklist.done():
+                yield format_ndjson("checklist", checklist.result())
+            await asyncio.wait({task})
+            error = task.exception()
+            if error is None:
+                yield format_ndjson("classification", task.result())
+            else:
+                detail = error.detail if isinstance(error, HTTPException) else str(error)
+                status_code = error.status_code if isinstance(error, HTTPException) else 500
+                yield format_ndjson("error", {"status": "error", "case_id": request.case_id, "status_code": status_code, "message": detail})
+        finally:
+            # Cliente desconectado: el análisis compartido sigue (shield) y queda en caché
+            if not task.done():
+                task.cancel()
+
+    return StreamingResponse(
+        stage_stream(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/analyze/{job_id}")
+async def get_analysis_job(job_id: str) -> Dict[str, Any]:
+    """Consulta el estado/resultado de un análisis encolado"""
+    task = analysis_jobs.get(job_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} no encontrado")
+    if not task.done():
+        return {"status": "running", "job_id": job_id}
+    error = task.exception()
+    if error is not None:
+        detail = error.detail if isinstance(error, HTTPException) else str(error)
+        return {"status": "error", "job_id": job_id, "message": detail}
+    return {"job_id": job_id, **task.result()}
+
+# Cuerpo de "/" serializado una sola vez: es estático durante toda la vida del proceso
+ROOT_RESPONSE_BODY = orjson.dumps({
+    "service": "Pipefy CrewAI Analysis Service v2.0",
+    "status": "running",
+    "architecture": "Enfoque Híbrido Inteligente",
+    "description": "Servicio de análisis especializado con herramientas simples",
+    "backend_url": BACKEND_URL
+})
+
 @app.get("/")
 async def root():
     """Endpoint raíz del servicio"""
-    return {
-        "service": "Pipefy CrewAI Analysis Service v2.0",
-        "status": "running",
-        "architecture": "Enfoque Híbrido Inteligente",
-        "description": "Servicio de análisis especializado con herramientas simples",
-        "backend_url": BACKEND_URL
-    }
+    return Response(content=ROOT_RESPONSE_BODY, media_type="application/json")
+
+# Resultado de /health reutilizado durante unos segundos (orquestadores lo consultan cada pocos segundos)
+HEALTH_CACHE_TTL = float(os.getenv("HEALTH_CACHE_TTL", "5"))
+_health_cache: Optional[Tuple[float, Dict[str, Any]]] = None
+
+async def _check_supabase() -> str:
+    """Sonda de Supabase vía supabase-py (en su pool de hilos dedicado)"""
+    if not supabase_client:
+        return "disconnected"
+    # Sonda mínima: una columna, una fila y sin count="exact" (que recorre toda la tabla)
+    query = supabase_client.table("documents").select("id").limit(1)
+    await asyncio.get_running_loop().run_in_executor(supabase_executor, query.execute)
+    return "connected"
+
+async def _check_backend() -> str:
+    """Sonda del backend con el cliente HTTP compartido de las herramientas"""
+    from src.tools.backend_api_tools import backend_http
+    try:
+        backend_response = await asyncio.to_thread(backend_http.get, "/health", timeout=5.0)
+        return "connected" if backend_response.status_code == 200 else "error"
+    except httpx.HTTPError:
+        return "disconnected"
 
 @app.get("/health")
 async def health_check():
     """Health check del servicio"""
+    global _health_cache
+    loop = asyncio.get_running_loop()
+    # Ocupación del análisis: siempre en vivo (no forma parte del resultado cacheado).
+    # Cuenta análisis (un turno por análisis), no pasos de validación/clasificación
+    analysis_status = {
+        "max_concurrent": MAX_CONCURRENT_ANALYSES,
+        "running": analyses_running,
+        "queued": analyses_waiting
+    }
+    if _health_cache is not None and _health_cache[0] > loop.time():
+        return {**_health_cache[1], "analysis": analysis_status}
     try:
-        # Verificar conexión a Supabase
-        if supabase_client:
-            test_response = supabase_client.table("documents").select("count", count="exact").limit(1).execute()
-            supabase_status = "connected"
-        else:
-            supabase_status = "disconnected"
-        
-        # Verificar conexión al backend
-        try:
-            with httpx.Client(timeout=5.0) as client:
-                backend_response = client.get(f"{BACKEND_URL}/health")
-                backend_status = "connected" if backend_response.status_code == 200 else "error"
-        except:
-            backend_status = "disconnected"
-        
-        return {
+        # Sondas independientes: en paralelo, la latencia es la de la más lenta
+        supabase_status, backend_status = await asyncio.gather(_check_supabase(), _check_backend())
+        result = {
             "status": "healthy",
             "timestamp": datetime.now().isoformat(),
             "services": {
@@ -375,12 +819,23 @@ async def health_check():
         }
     except Exception as e:
         logger.error(f"Health check failed: {e}")
-        return {
+        result = {
             "status": "unhealthy",
             "error": str(e),
             "timestamp": datetime.now().isoformat()
         }
+    _health_cache = (loop.time() + HEALTH_CACHE_TTL, result)
+    return {**result, "analysis": analysis_status}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8000))) 
\ No newline at end of file
+    # Con varios workers uvicorn necesita la app como import string; cada worker tiene su propio
+    # estado en memoria (caché, jobs de /analyze/async), por eso el default es 1
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8000)),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1"))
+    ) 
\ No newline at end of file
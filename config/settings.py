@@ -30,7 +30,7 @@ class Settings:
     LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
     
     # CrewAI Configuration
-    CREW_VERBOSE: bool = os.getenv("CREW_VERBOSE", "True").lower() == "true"
+    CREW_VERBOSE: bool = os.getenv("CREW_VERBOSE", "False").lower() == "true"
     CREW_MEMORY: bool = os.getenv("CREW_MEMORY", "True").lower() == "true"
     PROCESSING_TIMEOUT: int = int(os.getenv("PROCESSING_TIMEOUT", "300"))
     
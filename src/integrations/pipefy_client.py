@@ -1,19 +1,61 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import httpx
 import logging
 
 # Configurar logger
 logger = logging.getLogger(__name__)
 
+# Queries GraphQL constantes (definidas una vez, no por llamada)
+_GET_CARD_ATTACHMENTS_QUERY = """
+query GetCardAttachments($cardId: ID!) {
+  card(id: $cardId) {
+    attachments {
+      url
+      field {
+        id
+        label
+      }
+      filename
+    }
+  }
+}
+"""
+
 class PipefyAPIError(Exception):
     """Excepción personalizada para errores de la API de Pipefy"""
     pass
 
 class PipefyClient:
-    def __init__(self, api_url: str, headers: dict, timeout: int):
+    def __init__(self, api_url: str, headers: dict, timeout: int, client: Optional[httpx.AsyncClient] = None):
         self.api_url = api_url
         self.headers = headers
         self.timeout = timeout
+        # Cliente HTTP reutilizado entre queries (keep-alive): sin handshake TCP+TLS por llamada.
+        # Se puede inyectar uno compartido (lo cierra quien lo creó); si no, se crea en la primera
+        # query y se cierra con aclose() / "async with".
+        self._client = client
+        self._owns_client = client is None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+            )
+            self._owns_client = True
+        return self._client
+
+    async def aclose(self) -> None:
+        """Cierra el cliente HTTP propio y sus conexiones (un cliente inyectado no se toca)."""
+        if self._owns_client and self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def __aenter__(self) -> "PipefyClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
 
     async def execute_query(self, query: str, variables: Dict[str, Any] = None) -> Dict[str, Any]:
         """
@@ -30,22 +72,21 @@ class PipefyClient:
             PipefyAPIError: Si hay error en la API de Pipefy
         """
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    self.api_url,
-                    json={"query": query, "variables": variables or {}},
-                    headers=self.headers,
-                    timeout=self.timeout
-                )
-                response.raise_for_status()
-                result = response.json()
-                
-                if result.get("errors"):
-                    error_msg = f"Error GraphQL: {result['errors']}"
-                    logger.error(error_msg)
-                    raise PipefyAPIError(error_msg)
-                
-                return result.get("data", {})
+            response = await self._get_client().post(
+                self.api_url,
+                json={"query": query, "variables": variables or {}},
+                headers=self.headers,
+                timeout=self.timeout
+            )
+            response.raise_for_status()
+            result = response.json()
+            
+            if result.get("errors"):
+                error_msg = f"Error GraphQL: {result['errors']}"
+                logger.error(error_msg)
+                raise PipefyAPIError(error_msg)
+            
+            return result.get("data", {})
                 
         except httpx.HTTPStatusError as e:
             error_msg = f"Error HTTP en GraphQL: {e.response.status_code} - {e.response.text}"
@@ -73,25 +114,10 @@ class PipefyClient:
         Raises:
             PipefyAPIError: Si hay error en la API de Pipefy
         """
-        query = """
-        query GetCardAttachments(\$cardId: ID!) {
-          card(id: \$cardId) {
-            attachments {
-              url
-              field {
-                id
-                label
-              }
-              filename
-            }
-          }
-        }
-        """
-        
         variables = {"cardId": str(card_id)}
         
         try:
-            result = await self.execute_query(query, variables)
+            result = await self.execute_query(_GET_CARD_ATTACHMENTS_QUERY, variables)
             
             card_data = result.get("card")
             if not card_data:
@@ -101,18 +127,16 @@ class PipefyClient:
             
             attachments = card_data.get("attachments", [])
             
-            # Formatear documentos para CrewAI
-            documents = []
-            for attachment in attachments:
-                if not attachment.get("url"):
-                    continue
-                    
-                doc = {
+            # Formatear documentos para CrewAI (adjuntos sin URL se descartan)
+            documents = [
+                {
                     "name": attachment.get("filename", "unknown"),
                     "file_url": attachment["url"],
-                    "document_tag": attachment.get("field", {}).get("label", "").lower().replace(" ", "_")
+                    "document_tag": ((attachment.get("field") or {}).get("label") or "").lower().replace(" ", "_")
                 }
-                documents.append(doc)
+                for attachment in attachments
+                if attachment.get("url")
+            ]
             
             logger.info(f"✅ Obtenidos {len(documents)} documentos del card {card_id}")
             return documents
@@ -0,0 +1,91 @@
+"""
+Cachés en memoria con expiración: genérica (TTLCache) y de resultados de /analyze (AnalysisCache).
+"""
+import hashlib
+import logging
+import threading
+import time
+import orjson
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+class TTLCache:
+    """
+    Caché LRU thread-safe con expiración (TTL) por entrada.
+    Las claves las calcula quien la usa; maxsize acota la memoria.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600.0):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Retorna el valor cacheado o None si no existe o expiró."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        """Guarda un valor, descartando el menos usado si se supera maxsize."""
+        with self._lock:
+            self._data[key] = (time.monotonic() + self._ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        """Vacía la caché."""
+        with self._lock:
+            self._data.clear()
+
+class AnalysisCache(TTLCache):
+    """
+    Caché de resultados de /analyze.
+    Evita repetir la validación IA y la clasificación cuando llega
+    exactamente el mismo caso con los mismos documentos.
+    """
+
+    @staticmethod
+    def build_key(
+        case_id: str,
+        pipe_id: Optional[str],
+        documents: List[Dict[str, Any]],
+        cnpj: Optional[str] = None
+    ) -> str:
+        """
+        Calcula la clave de caché a partir del caso y de sus documentos.
+
+        Args:
+            case_id: ID del caso/card
+            pipe_id: ID del pipe (opcional)
+            documents: Lista de documentos (name, file_url, document_tag, parsed_content)
+            cnpj: CNPJ del card (opcional; cambia el resultado vía enriquecimiento del Cartão CNPJ)
+
+        Returns:
+            str: Hash sha256 del contenido canónico de la request
+        """
+        fingerprints = sorted(
+            (
+                doc.get("file_url", ""),
+                doc.get("name", ""),
+                doc.get("document_tag", ""),
+                hashlib.sha256(doc.get("parsed_content", "").encode("utf-8")).hexdigest()
+            )
+            for doc in documents
+        )
+        payload = orjson.dumps([case_id, pipe_id or "default", cnpj or "", fingerprints])
+        return hashlib.sha256(payload).hexdigest()
+
+# Instancia global de la caché
+analysis_cache = AnalysisCache()
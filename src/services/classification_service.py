@@ -1,22 +1,41 @@
 """
 Servicio de clasificación de documentos basado en FAQ.pdf v2.0.
 """
+import atexit
+import functools
+import io
 import logging
-from typing import Dict, List, Any, Optional, Tuple
+import re
+import time
+import httpx
+import orjson
+from typing import Dict, List, Any, NamedTuple, Optional, Tuple
 from enum import Enum
 from dataclasses import dataclass
 from datetime import datetime
+from config import settings
 from src.services.faq_knowledge_service import faq_knowledge_service
 
 logger = logging.getLogger(__name__)
 
+# Cliente HTTP del backend de ingestion (Cartão CNPJ): reutiliza conexiones keep-alive
+# entre casos (httpx.Client es thread-safe)
+ingestion_http = httpx.Client(
+    base_url=settings.DOCUMENT_INGESTION_URL.rstrip('/'),
+    timeout=60.0,
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+)
+# Vive lo mismo que el proceso: se cierra al salir
+atexit.register(ingestion_http.close)
+CARTAO_CNPJ_ENDPOINT = "/api/v1/gerar_e_armazenar_cartao_cnpj"
+
 class ClassificationType(Enum):
     """Tipos de clasificación según FAQ v2.0."""
     APROVADO = "Aprovado"
     PENDENCIA_BLOQUEANTE = "Pendencia_Bloqueante"
     PENDENCIA_NAO_BLOQUEANTE = "Pendencia_NaoBloqueante"
 
-@dataclass
+@dataclass(slots=True)
 class DocumentAnalysis:
     """Resultado del análisis de un documento."""
     document_type: str
@@ -26,7 +45,7 @@ class DocumentAnalysis:
     confidence_score: float
     metadata: Dict[str, Any]
 
-@dataclass
+@dataclass(slots=True)
 class ClassificationResult:
     """Resultado de la clasificación de un caso."""
     classification_type: ClassificationType
@@ -37,6 +56,66 @@ class ClassificationResult:
     auto_actions: List[Dict[str, Any]]
     summary: str
 
+class DocumentRule(NamedTuple):
+    """Reglas de un tipo de documento, precompiladas desde el FAQ."""
+    required: bool
+    blocking_if_invalid: bool
+    validate_expiry: bool
+    auto_generable: bool
+    required_fields: Tuple[str, ...]
+
+# Valores por defecto para tipos de documento sin reglas en el FAQ
+_DEFAULT_DOCUMENT_RULE = DocumentRule(True, True, False, False, ())
+
+# Todo lo que no sea dígito (normalización del CNPJ: "11.222.333/0001-81" -> "11222333000181")
+_NON_DIGITS_RE = re.compile(r"\D")
+
+# Prefijos de línea del resumen markdown (cada línea empieza con el salto de la anterior)
+_SUMMARY_DOC_VALID = "\n- ✅ "
+_SUMMARY_DOC_INVALID = "\n- ❌ "
+_SUMMARY_DOC_ISSUE = "\n  - "
+_SUMMARY_BLOCKING = "\n- 🚫 "
+_SUMMARY_NON_BLOCKING = "\n- ⚠️ "
+_SUMMARY_ACTION = "\n- 🔄 "
+
+@functools.lru_cache(maxsize=256)
+def _parse_expiry_ts(expiry_date: str) -> float:
+    """Timestamp de una fecha ISO de vencimiento (memoizado: las mismas fechas se repiten entre casos)."""
+    return datetime.fromisoformat(expiry_date).timestamp()
+
+def _compile_document_rules(documents: Dict[str, Any]) -> Dict[str, DocumentRule]:
+    """
+    Precalcula por tipo de documento los flags del FAQ que consulta la clasificación,
+    para no recorrer los dicts de reglas en cada documento de cada caso.
+    """
+    return {
+        doc_type: DocumentRule(
+            required=rules.get("required", True),
+            blocking_if_invalid=rules.get("blocking_if_invalid", True),
+            validate_expiry=rules.get("validate_expiry", False),
+            auto_generable=rules.get("auto_generable", False),
+            required_fields=tuple(rules.get("required_fields", ()))
+        )
+        for doc_type, rules in documents.items()
+    }
+
+@functools.lru_cache(maxsize=1)
+def _load_rules_cached() -> Tuple[Dict[str, Any], Dict[str, DocumentRule]]:
+    """
+    Extrae las reglas del FAQ una sola vez por proceso, compartidas por todas las
+    instancias de ClassificationService. Retorna (reglas por sección, flags por documento).
+    """
+    rules = {
+        # Reglas de documentos
+        "documents": faq_knowledge_service.extract_rules("documentos"),
+        # Reglas de pendencias
+        "issues": faq_knowledge_service.extract_rules("pendencias"),
+        # Reglas de acciones automáticas
+        "actions": faq_knowledge_service.extract_rules("acciones")
+    }
+    # Flags por tipo de documento, precompilados una sola vez
+    return rules, _compile_document_rules(rules["documents"])
+
 class ClassificationService:
     """
     Servicio de clasificación de documentos basado en FAQ v2.0.
@@ -45,25 +124,25 @@ class ClassificationService:
     
     def __init__(self):
         self._rules = {}
+        self._doc_meta: Dict[str, DocumentRule] = {}
         self._load_rules()
     
     def _load_rules(self):
-        """Carga las reglas del FAQ."""
+        """Carga las reglas del FAQ (memoizadas a nivel de módulo)."""
         try:
-            # Cargar reglas de documentos
-            self._rules["documents"] = faq_knowledge_service.extract_rules("documentos")
-            
-            # Cargar reglas de pendencias
-            self._rules["issues"] = faq_knowledge_service.extract_rules("pendencias")
-            
-            # Cargar reglas de acciones automáticas
-            self._rules["actions"] = faq_knowledge_service.extract_rules("acciones")
-            
+            rules, self._doc_meta = _load_rules_cached()
+            self._rules = dict(rules)
             logger.info("✅ Reglas cargadas exitosamente del FAQ")
             
         except Exception as e:
             logger.error(f"❌ Error cargando reglas del FAQ: {e}")
             self._rules = {}
+            self._doc_meta = {}
+    
+    @classmethod
+    def invalidate_cache(cls) -> None:
+        """Descarta las reglas memoizadas (p. ej. tras actualizar el FAQ); aplica a las nuevas instancias."""
+        _load_rules_cached.cache_clear()
     
     def classify_documents(self, documents_data: Dict[str, Any], card_data: Dict[str, Any], case_id: str) -> ClassificationResult:
         """
@@ -76,40 +155,44 @@ class ClassificationService:
             ClassificationResult: Resultado de la clasificación
         """
         try:
-            logger.info(f"🔍 Consultando reglas de documentos en FAQ.pdf...")
-            required_docs = self._rules["documents"].keys()
-            logger.info(f"📋 Documentos requeridos según FAQ: {list(required_docs)}")
+            required_docs = self._doc_meta.keys()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("📋 Documentos requeridos según FAQ: %s", list(required_docs))
             # Validar presencia de todos los documentos requeridos
             document_analyses = []
             docs_present = set(documents_data.keys())
             auto_actions_log = []
+            # Un solo "ahora" para todo el caso
+            now_ts = time.time()
+            # Score de confianza acumulado en la misma pasada del análisis
+            score_total = 0.0
             for doc_type in required_docs:
                 doc_data = documents_data.get(doc_type, {})
-                analysis = self._analyze_document(doc_type, doc_data)
+                analysis = self._analyze_document(doc_type, doc_data, now_ts)
                 document_analyses.append(analysis)
-                logger.info(f"🔎 Documento '{doc_type}': presente={analysis.is_present}, válido={analysis.is_valid}, issues={analysis.issues}")
+                score_total += analysis.confidence_score
             # Enriquecimiento automático si falta Cartão CNPJ
             cartao_cnpj_tag = "cartao_cnpj"
             cartao_cnpj_analysis = next((a for a in document_analyses if a.document_type == cartao_cnpj_tag), None)
             if cartao_cnpj_analysis and not cartao_cnpj_analysis.is_present:
                 logger.info(f"⚠️ Falta Cartão CNPJ. Intentando enriquecer usando EnriquecerClienteAPITool...")
                 cnpj_raw = card_data.get("cnpj", "")
-                cnpj_clean = ''.join(filter(str.isdigit, str(cnpj_raw)))
+                cnpj_clean = _NON_DIGITS_RE.sub("", str(cnpj_raw))
                 logger.info(f"🔢 CNPJ extraído del card: '{cnpj_raw}' → normalizado: '{cnpj_clean}'")
                 enrich_result = None
                 if cnpj_clean and len(cnpj_clean) == 14:
-                    # Llamada real al backend de ingestion
-                    import httpx
-                    from config import settings
-                    ingestion_url = settings.DOCUMENT_INGESTION_URL.rstrip('/')
-                    endpoint = f"{ingestion_url}/api/v1/gerar_e_armazenar_cartao_cnpj"
+                    # Llamada real al backend de ingestion (cliente compartido, conexiones reutilizadas)
                     payload = {"cnpj": cnpj_clean, "case_id": case_id}
                     try:
-                        logger.info(f"[CARTAO_CNPJ] Llamando a {endpoint} con payload: {payload}")
-                        response = httpx.post(endpoint, json=payload, timeout=60)
+                        logger.info(f"[CARTAO_CNPJ] Llamando a {CARTAO_CNPJ_ENDPOINT} con payload: {payload}")
+                        response = ingestion_http.post(
+                            CARTAO_CNPJ_ENDPOINT,
+                            content=orjson.dumps(payload),
+                            headers={"Content-Type": "application/json"}
+                        )
                         response.raise_for_status()
-                        enrich_result = response.json()
-                        logger.info(f"[CARTAO_CNPJ] Respuesta backend: {enrich_result}")
+                        enrich_result = orjson.loads(response.content)
+                        logger.debug("[CARTAO_CNPJ] Respuesta backend: %s", enrich_result)
                     except Exception as e:
                         logger.error(f"[CARTAO_CNPJ] Error llamando al backend de ingestion: {e}")
                         enrich_result = {"success": False, "error": str(e)}
@@ -140,8 +223,8 @@ class ClassificationService:
             # Agregar acciones automáticas de enriquecimiento
             if auto_actions_log:
                 auto_actions.extend(auto_actions_log)
-            # Calcular score de confianza
-            confidence_score = self._calculate_confidence_score(document_analyses)
+            # Score de confianza general: promedio de los documentos
+            confidence_score = score_total / len(document_analyses) if document_analyses else 0.0
             # Generar resumen
             summary = self._generate_summary(
                 classification_type,
@@ -150,7 +233,19 @@ class ClassificationService:
                 non_blocking_issues,
                 auto_actions
             )
-            logger.info(f"📄 Resumen de análisis:\n{summary}")
+            # Un único registro INFO por caso; el detalle por documento y el resumen completo solo en DEBUG
+            if logger.isEnabledFor(logging.DEBUG):
+                for analysis in document_analyses:
+                    logger.debug(
+                        "🔎 Documento '%s': presente=%s, válido=%s, issues=%s",
+                        analysis.document_type, analysis.is_present, analysis.is_valid, analysis.issues
+                    )
+                logger.debug("📄 Resumen de análisis:\n%s", summary)
+            logger.info(
+                "🔎 Clasificación case_id %s: %s (%d documentos, %d bloqueantes, %d no bloqueantes, %d acciones)",
+                case_id, classification_type.value, len(document_analyses),
+                len(blocking_issues), len(non_blocking_issues), len(auto_actions)
+            )
             return ClassificationResult(
                 classification_type=classification_type,
                 document_analyses=document_analyses,
@@ -164,35 +259,35 @@ class ClassificationService:
             logger.error(f"❌ Error en clasificación de documentos: {e}")
             raise
     
-    def _analyze_document(self, doc_type: str, doc_data: Dict[str, Any]) -> DocumentAnalysis:
+    def _analyze_document(self, doc_type: str, doc_data: Dict[str, Any], now_ts: Optional[float] = None) -> DocumentAnalysis:
         """Analiza un documento específico según las reglas del FAQ, usando parsed_content."""
         try:
-            doc_rules = self._rules["documents"].get(doc_type, {})
+            doc_rule = self._doc_meta.get(doc_type, _DEFAULT_DOCUMENT_RULE)
             is_valid = True
             issues = []
             # Verificar presencia usando parsed_content
             parsed_content = doc_data.get("parsed_content", "")
             is_present = bool(parsed_content and parsed_content.strip())
-            if not is_present and doc_rules.get("required", True):
+            if not is_present and doc_rule.required:
                 is_valid = False
                 issues.append(f"Documento {doc_type} es requerido pero no tiene contenido parseado ('parsed_content')")
             # Si está presente, validar según reglas (puedes agregar aquí lógica de validación sobre el texto)
             if is_present:
+                # Validaciones de la más barata a la más cara: campos requeridos (dict) antes que fechas (parseo)
+                # Validar campos requeridos (puedes hacer validaciones sobre el texto de parsed_content aquí)
+                for field in doc_rule.required_fields:
+                    if not doc_data.get(field):
+                        is_valid = False
+                        issues.append(f"Campo requerido '{field}' faltante en {doc_type}")
                 # Validar fecha si aplica
-                if "expiry_date" in doc_data and doc_rules.get("validate_expiry", False):
+                if doc_rule.validate_expiry and "expiry_date" in doc_data:
                     try:
-                        expiry_date = datetime.fromisoformat(doc_data["expiry_date"])
-                        if expiry_date < datetime.now():
+                        if _parse_expiry_ts(doc_data["expiry_date"]) < (now_ts if now_ts is not None else time.time()):
                             is_valid = False
                             issues.append(f"Documento {doc_type} está expirado")
                     except ValueError:
                         is_valid = False
                         issues.append(f"Documento {doc_type} tiene formato de fecha inválido: {doc_data['expiry_date']}")
-                # Validar campos requeridos (puedes hacer validaciones sobre el texto de parsed_content aquí)
-                for field in doc_rules.get("required_fields", []):
-                    if field not in doc_data or not doc_data[field]:
-                        is_valid = False
-                        issues.append(f"Campo requerido '{field}' faltante en {doc_type}")
             confidence_score = 1.0 if is_valid and is_present else 0.5
             return DocumentAnalysis(
                 document_type=doc_type,
@@ -209,22 +304,15 @@ class ClassificationService:
     def _determine_classification(self, analyses: List[DocumentAnalysis]) -> ClassificationType:
         """Determina la clasificación general según el FAQ v2.0."""
         try:
-            # Verificar si hay documentos inválidos bloqueantes
-            has_blocking_issues = any(
-                not analysis.is_valid and
-                self._rules["documents"].get(analysis.document_type, {}).get("blocking_if_invalid", True)
-                for analysis in analyses
-            )
-            
-            if has_blocking_issues:
-                return ClassificationType.PENDENCIA_BLOQUEANTE
-            
-            # Verificar si hay documentos inválidos no bloqueantes
-            has_non_blocking_issues = any(
-                not analysis.is_valid and
-                not self._rules["documents"].get(analysis.document_type, {}).get("blocking_if_invalid", True)
-                for analysis in analyses
-            )
+            # Una sola pasada: el primer inválido bloqueante decide la clasificación
+            doc_meta = self._doc_meta
+            has_non_blocking_issues = False
+            for analysis in analyses:
+                if analysis.is_valid:
+                    continue
+                if doc_meta.get(analysis.document_type, _DEFAULT_DOCUMENT_RULE).blocking_if_invalid:
+                    return ClassificationType.PENDENCIA_BLOQUEANTE
+                has_non_blocking_issues = True
             
             if has_non_blocking_issues:
                 return ClassificationType.PENDENCIA_NAO_BLOQUEANTE
@@ -242,13 +330,12 @@ class ClassificationService:
             non_blocking_issues = []
             
             for analysis in analyses:
-                doc_rules = self._rules["documents"].get(analysis.document_type, {})
-                
-                for issue in analysis.issues:
-                    if doc_rules.get("blocking_if_invalid", True):
-                        blocking_issues.append(issue)
-                    else:
-                        non_blocking_issues.append(issue)
+                if not analysis.issues:
+                    continue
+                if self._doc_meta.get(analysis.document_type, _DEFAULT_DOCUMENT_RULE).blocking_if_invalid:
+                    blocking_issues.extend(analysis.issues)
+                else:
+                    non_blocking_issues.extend(analysis.issues)
             
             return blocking_issues, non_blocking_issues
             
@@ -278,11 +365,11 @@ class ClassificationService:
                 })
             
             # Acciones por documento
+            doc_meta = self._doc_meta
             for analysis in analyses:
-                doc_rules = self._rules["documents"].get(analysis.document_type, {})
-                
-                # Si es auto-generable y está ausente o inválido
-                if doc_rules.get("auto_generable", False) and (not analysis.is_present or not analysis.is_valid):
+                # Si está ausente o inválido y es auto-generable
+                if (not analysis.is_present or not analysis.is_valid) and \
+                        doc_meta.get(analysis.document_type, _DEFAULT_DOCUMENT_RULE).auto_generable:
                     actions.append({
                         "type": "GENERATE_DOCUMENT",
                         "document_type": analysis.document_type,
@@ -303,19 +390,6 @@ class ClassificationService:
             logger.error(f"❌ Error determinando acciones automáticas: {e}")
             raise
     
-    def _calculate_confidence_score(self, analyses: List[DocumentAnalysis]) -> float:
-        """Calcula el score de confianza general."""
-        try:
-            if not analyses:
-                return 0.0
-            
-            total_score = sum(analysis.confidence_score for analysis in analyses)
-            return total_score / len(analyses)
-            
-        except Exception as e:
-            logger.error(f"❌ Error calculando score de confianza: {e}")
-            return 0.0
-    
     def _generate_summary(
         self,
         classification: ClassificationType,
@@ -326,35 +400,40 @@ class ClassificationService:
     ) -> str:
         """Genera un resumen en formato markdown."""
         try:
-            summary = [
-                f"# Resumen de Clasificación\n",
-                f"## Status: {classification.value}\n",
-                "\n## Documentos Analizados:\n"
-            ]
+            buf = io.StringIO()
+            w = buf.write
+            w("# Resumen de Clasificación\n\n## Status: ")
+            w(classification.value)
+            w("\n\n\n## Documentos Analizados:\n")
             
             for analysis in analyses:
-                status = "✅" if analysis.is_valid else "❌"
-                summary.append(f"- {status} {analysis.document_type}")
-                if analysis.issues:
-                    for issue in analysis.issues:
-                        summary.append(f"  - {issue}")
+                w(_SUMMARY_DOC_VALID if analysis.is_valid else _SUMMARY_DOC_INVALID)
+                w(analysis.document_type)
+                for issue in analysis.issues:
+                    w(_SUMMARY_DOC_ISSUE)
+                    w(issue)
             
             if blocking_issues:
-                summary.append("\n## Pendencias Bloqueantes:")
+                w("\n\n## Pendencias Bloqueantes:")
                 for issue in blocking_issues:
-                    summary.append(f"- 🚫 {issue}")
+                    w(_SUMMARY_BLOCKING)
+                    w(issue)
             
             if non_blocking_issues:
-                summary.append("\n## Pendencias No Bloqueantes:")
+                w("\n\n## Pendencias No Bloqueantes:")
                 for issue in non_blocking_issues:
-                    summary.append(f"- ⚠️ {issue}")
+                    w(_SUMMARY_NON_BLOCKING)
+                    w(issue)
             
             if auto_actions:
-                summary.append("\n## Acciones Automáticas:")
+                w("\n\n## Acciones Automáticas:")
                 for action in auto_actions:
-                    summary.append(f"- 🔄 {action['type']}: {action.get('reason', '')}")
+                    w(_SUMMARY_ACTION)
+                    w(action['type'])
+                    w(": ")
+                    w(action.get('reason', ''))
             
-            return "\n".join(summary)
+            return buf.getvalue()
             
         except Exception as e:
             logger.error(f"❌ Error generando resumen: {e}")
@@ -1,18 +1,60 @@
 """
 Servicio optimizado para el manejo del FAQ.pdf como fuente de conocimiento.
 """
-import os
+import hashlib
 import logging
-import json
+import os
+import threading
+import orjson
 from typing import Dict, List, Any, Optional
 from datetime import datetime, timedelta
 from pathlib import Path
 from crewai.knowledge.source.pdf_knowledge_source import PDFKnowledgeSource
 import unicodedata
 from crewai import LLM
+from src.services.analysis_cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# Caché de la validación IA por contenido del prompt: los mismos documentos
+# (aunque lleguen en otro case_id o pipe) no vuelven a consultar el LLM
+VALIDATION_CACHE_TTL = float(os.getenv("VALIDATION_CACHE_TTL", "86400"))
+_validation_cache = TTLCache(maxsize=1024, ttl=VALIDATION_CACHE_TTL)
+
+# Prompt de matching IA, dividido en la parte que depende del ítem del checklist
+# y el bloque de documentos (invariante durante una validación)
+_MATCHING_PROMPT_HEADER = """
+Eres un asistente experto en validación documental para onboarding empresarial. Tu tarea es analizar si alguno de los documentos anexados corresponde al ítem del checklist:
+
+Ítem del checklist: '{nombre}'
+"""
+
+_MATCHING_PROMPT_DOCUMENTS = """
+Documentos anexados (nombre): {doc_names}
+
+Fragmentos de contenido de cada documento (máx 500 caracteres):
+{doc_contents}
+
+Responde SOLO con el nombre exacto del documento que corresponde, o una lista de nombres si hay más de uno. Si ninguno corresponde, responde exactamente 'Ninguno'. Si tienes dudas, elige el más probable y explica brevemente por qué.
+"""
+
+def _compile_checklist(checklist: list) -> tuple:
+    """
+    Precalcula por ítem del checklist lo que no depende de la request:
+    (nombre, regla, cabecera del prompt, es_bloqueante, genera_cartao_cnpj).
+    """
+    items = []
+    for regla in checklist:
+        nombre = regla["Item do Checklist"].strip("* ")
+        items.append((
+            nombre,
+            regla,
+            _MATCHING_PROMPT_HEADER.format(nombre=nombre),
+            "Bloqueante" in regla["Classificação da Pendência (se houver)"],
+            "cartão cnpj" in nombre.lower()
+        ))
+    return tuple(items)
+
 def _normalize_name(name):
     # Elimina acentos, pasa a minúsculas y quita caracteres especiales
     name = unicodedata.normalize('NFKD', name).encode('ASCII', 'ignore').decode('ASCII')
@@ -32,7 +74,11 @@ class FAQKnowledgeService:
         self._cache_duration = timedelta(minutes=30)  # Recargar cada 30 minutos
         self._rules_cache: Dict[str, Any] = {}
         self._faq_path: Optional[Path] = None
+        self._faq_hash: Optional[str] = None
         self._checklist: Optional[list] = None
+        self._checklist_items: tuple = ()
+        # Serializa la (re)construcción de la fuente: dos hilos no procesan el PDF a la vez
+        self._source_lock = threading.Lock()
         self._checklist_path = self._find_checklist_file()
         
     def _find_faq_file(self) -> Optional[Path]:
@@ -69,12 +115,26 @@ class FAQKnowledgeService:
         logger.error("❌ FAQ.pdf no encontrado en ninguna ubicación conocida")
         return None
     
+    def _compute_faq_hash(self) -> Optional[str]:
+        """
+        Calcula el sha256 del contenido del FAQ.pdf.
+        
+        Returns:
+            str: Hash hexadecimal o None si el archivo no existe
+        """
+        if not self._faq_path or not self._faq_path.exists():
+            return None
+        return hashlib.sha256(self._faq_path.read_bytes()).hexdigest()
+    
     def _should_reload(self) -> bool:
         """
         Determina si el FAQ debe ser recargado basado en:
         1. Si nunca fue cargado
-        2. Si el caché expiró
-        3. Si el archivo fue modificado
+        2. Si el caché expiró o el archivo fue modificado, y además
+        3. Si el contenido (sha256) del FAQ.pdf cambió
+        
+        Re-embeber el FAQ es caro, así que un archivo con el mismo hash
+        nunca provoca una recarga.
         
         Returns:
             bool: True si debe recargarse
@@ -85,16 +145,23 @@ class FAQKnowledgeService:
         now = datetime.now()
         
         # Verificar expiración del caché
-        if now - self._last_load_time > self._cache_duration:
-            return True
+        expired = now - self._last_load_time > self._cache_duration
             
         # Verificar si el archivo fue modificado
+        modified = False
         if self._faq_path and self._faq_path.exists():
             mtime = datetime.fromtimestamp(self._faq_path.stat().st_mtime)
-            if mtime > self._last_load_time:
-                return True
+            modified = mtime > self._last_load_time
+        
+        if not (expired or modified):
+            return False
+        
+        # Mismo contenido: renovar el caché sin re-embeber
+        if self._compute_faq_hash() == self._faq_hash:
+            self._last_load_time = now
+            return False
                 
-        return False
+        return True
     
     def get_knowledge_source(self) -> Optional[PDFKnowledgeSource]:
         """
@@ -103,6 +170,10 @@ class FAQKnowledgeService:
         Returns:
             PDFKnowledgeSource: Fuente de conocimiento o None si hay error
         """
+        with self._source_lock:
+            return self._get_knowledge_source_locked()
+
+    def _get_knowledge_source_locked(self) -> Optional[PDFKnowledgeSource]:
         try:
             # Encontrar el archivo si aún no lo hemos hecho
             if not self._faq_path:
@@ -114,18 +185,13 @@ class FAQKnowledgeService:
             if self._should_reload():
                 logger.info("🔄 Recargando FAQ.pdf...")
                 
-                # Cambiar al directorio correcto para PDFKnowledgeSource
-                original_cwd = os.getcwd()
-                os.chdir(str(self._faq_path.parent.parent))
-                
-                try:
-                    # PDFKnowledgeSource buscará en knowledge/FAQ.pdf
-                    self._knowledge_source = PDFKnowledgeSource(file_paths=["FAQ.pdf"])
-                    self._last_load_time = datetime.now()
-                    self._rules_cache = {}  # Limpiar caché de reglas
-                    logger.info("✅ FAQ.pdf recargado exitosamente")
-                finally:
-                    os.chdir(original_cwd)
+                # Path absoluto: PDFKnowledgeSource no antepone 'knowledge/',
+                # así que no hace falta os.chdir (global al proceso, inseguro entre hilos)
+                self._knowledge_source = PDFKnowledgeSource(file_paths=[self._faq_path.resolve()])
+                self._last_load_time = datetime.now()
+                self._faq_hash = self._compute_faq_hash()
+                self._rules_cache = {}  # Limpiar caché de reglas
+                logger.info("✅ FAQ.pdf recargado exitosamente")
             
             return self._knowledge_source
             
@@ -172,8 +238,8 @@ class FAQKnowledgeService:
         # Render y local
         paths = [
             Path("/opt/render/project/src/triagem_crew/knowledge/faq_checklist.json"),
-            Path(__file__).parent.parent / "triagem_crew" / "knowledge" / "faq_checklist.json",
-            Path(__file__).parent.parent / "knowledge" / "faq_checklist.json"
+            Path(__file__).parent.parent.parent / "triagem_crew" / "knowledge" / "faq_checklist.json",
+            Path(__file__).parent.parent.parent / "knowledge" / "faq_checklist.json"
         ]
         for path in paths:
             if path.exists():
@@ -192,8 +258,8 @@ class FAQKnowledgeService:
             logger.error("❌ No se pudo cargar el checklist JSON")
             return None
         try:
-            with open(self._checklist_path, encoding="utf-8") as f:
-                self._checklist = json.load(f)
+            self._checklist = orjson.loads(self._checklist_path.read_bytes())
+            self._checklist_items = _compile_checklist(self._checklist)
             logger.info(f"✅ Checklist cargado con {len(self._checklist)} reglas")
             return self._checklist
         except Exception as e:
@@ -204,38 +270,45 @@ class FAQKnowledgeService:
         checklist = self.load_checklist()
         if not checklist:
             logger.error("❌ No hay checklist para validar documentos")
-            return {"status": "error", "logs": ["Checklist no disponible"], "detalles": {}}
+            return {"status": "error", "logs": ["Checklist no disponible"], "detalles": {}, "llm_errors": False}
         logs = []
         detalles = {}
         status_geral = "Aprovado"
         acciones_automaticas = []
+        # Los documentos son los mismos para todos los ítems: se preparan una sola vez.
+        # JSON compacto (sin indentación) para no gastar tokens del prompt en espacios.
+        doc_names = [d.get("name", "") for d in documentos]
+        doc_names_lower = [name.lower() for name in doc_names]
+        doc_contents_json = orjson.dumps(
+            {d.get("name", ""): d.get("parsed_content", "")[:500] for d in documentos}
+        ).decode()
+        # Bloque de documentos del prompt, idéntico para todos los ítems del checklist
+        documents_block = _MATCHING_PROMPT_DOCUMENTS.format(doc_names=doc_names, doc_contents=doc_contents_json)
+        cache_key = hashlib.sha256(documents_block.encode("utf-8")).hexdigest()
+        cached = _validation_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"[MATCHING-IA] Validación servida desde caché. Status general: {cached['status']}")
+            return cached
         llm = LLM(model="gpt-4o-mini")
         logger.info(f"[MATCHING-IA] Iniciando validación IA de documentos. Total ítems checklist: {len(checklist)}")
-        for regla in checklist:
-            nombre = regla["Item do Checklist"].strip("* ")
-            doc_names = [d.get("name", "") for d in documentos]
-            doc_contents = {d.get("name", ""): d.get("parsed_content", "")[:500] for d in documentos}
-            prompt = f"""
-Eres un asistente experto en validación documental para onboarding empresarial. Tu tarea es analizar si alguno de los documentos anexados corresponde al ítem del checklist:
-
-Ítem del checklist: '{nombre}'
-
-Documentos anexados (nombre): {doc_names}
-
-Fragmentos de contenido de cada documento (máx 500 caracteres):
-{json.dumps(doc_contents, ensure_ascii=False, indent=2)}
-
-Responde SOLO con el nombre exacto del documento que corresponde, o una lista de nombres si hay más de uno. Si ninguno corresponde, responde exactamente 'Ninguno'. Si tienes dudas, elige el más probable y explica brevemente por qué.
-"""
-            logger.info(f"[MATCHING-IA] Prompt enviado al LLM para '{nombre}': {prompt[:300]}...")
+        llm_errors = False
+        for nombre, regla, prompt_header, es_bloqueante, genera_cartao_cnpj in self._checklist_items:
+            prompt = prompt_header + documents_block
+            logger.debug("[MATCHING-IA] Prompt enviado al LLM para '%s': %.300s...", nombre, prompt)
             try:
                 respuesta = llm(prompt)
-                logger.info(f"[MATCHING-IA] Respuesta del LLM para '{nombre}': {respuesta}")
+                logger.debug("[MATCHING-IA] Respuesta del LLM para '%s': %s", nombre, respuesta)
                 doc_match = None
                 razonamiento = respuesta
-                for i, d in enumerate(documentos):
-                    doc_name = d.get("name", "")
-                    if doc_name in respuesta or doc_name.lower() in respuesta.lower():
+                # La respuesta se normaliza una sola vez; la comparación exacta va primero
+                respuesta_lower = None
+                for i, doc_name in enumerate(doc_names):
+                    if doc_name in respuesta:
+                        doc_match = i
+                        break
+                    if respuesta_lower is None:
+                        respuesta_lower = respuesta.lower()
+                    if doc_names_lower[i] in respuesta_lower:
                         doc_match = i
                         break
                 if doc_match is not None:
@@ -247,11 +320,11 @@ Responde SOLO con el nombre exacto del documento que corresponde, o una lista de
                     detalles[nombre] = {"status": "Faltante", "regla": regla, "validacion": "IA", "razonamiento": razonamiento}
                     logs.append(f"❌ Falta documento: {nombre}")
                     logger.info(f"[MATCHING-IA] Documento faltante según IA: '{nombre}'")
-                    if "Bloqueante" in regla["Classificação da Pendência (se houver)"]:
+                    if es_bloqueante:
                         status_geral = "Pendencia_Bloqueante"
                     elif status_geral != "Pendencia_Bloqueante":
                         status_geral = "Pendencia_NaoBloqueante"
-                    if "Cartão CNPJ" in nombre or "cartão cnpj" in nombre.lower():
+                    if genera_cartao_cnpj:
                         acciones_automaticas.append({
                             "type": "GENERATE_DOCUMENT",
                             "document_type": nombre,
@@ -260,10 +333,15 @@ Responde SOLO con el nombre exacto del documento que corresponde, o una lista de
                         })
             except Exception as e:
                 logger.warning(f"[MATCHING-IA] Error consultando LLM para matching de '{nombre}': {e}")
+                llm_errors = True
                 detalles[nombre] = {"status": "Faltante", "regla": regla, "error": str(e)}
                 logs.append(f"❌ Falta documento: {nombre} (error IA)")
         logger.info(f"[MATCHING-IA] Validación IA completada. Status general: {status_geral}")
-        return {"status": status_geral, "logs": logs, "detalles": detalles, "acciones_automaticas": acciones_automaticas}
+        resultado = {"status": status_geral, "logs": logs, "detalles": detalles, "acciones_automaticas": acciones_automaticas, "llm_errors": llm_errors}
+        # Solo se cachean validaciones completas (un error del LLM no debe fijarse como "Faltante")
+        if not llm_errors:
+            _validation_cache.set(cache_key, resultado)
+        return resultado
 
 # Instancia global del servicio
 faq_knowledge_service = FAQKnowledgeService() 
\ No newline at end of file
@@ -0,0 +1,125 @@
+"""
+Escritura por lotes de la tabla informe_cadastro (Supabase).
+"""
+import asyncio
+import logging
+import httpx
+import orjson
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Marca de fin de cola: el writer vacía lo pendiente y termina
+_STOP = object()
+
+def _is_retryable(error: Exception) -> bool:
+    """
+    Solo se reintentan fallos transitorios: errores de transporte (timeout, conexión) y 5xx.
+    Un 4xx (constraint, tipo inválido...) u otro error depende de los datos y fallaría igual.
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+class InformeBatchWriter:
+    """
+    Acumula los informes en una cola y los inserta en lotes
+    (hasta batch_size filas o flush_interval segundos), en vez de
+    un insert por request en el camino de /analyze.
+    """
+
+    def __init__(
+        self,
+        insert_batch: Callable[[List[Dict[str, Any]]], Awaitable[Any]],
+        batch_size: int = 100,
+        flush_interval: float = 2.0,
+        max_retries: int = 2,
+        retry_backoff: float = 0.5
+    ):
+        self._insert_batch = insert_batch
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_retries = max_retries
+        self._retry_backoff = retry_backoff
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        """Indica si el writer en segundo plano está activo."""
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        """Arranca el writer en el event loop actual (llamar desde el lifespan)."""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def enqueue(self, row: Dict[str, Any]) -> None:
+        """
+        Encola un informe para el próximo lote sin esperar al insert (fire-and-forget).
+        Sin writer activo (p. ej. fuera del lifespan) se inserta directamente.
+        """
+        if not self.running:
+            await self._flush([row])
+            return
+        self._queue.put_nowait(row)
+
+    async def stop(self) -> None:
+        """Vacía la cola (inserta lo pendiente) y detiene el writer."""
+        if not self.running:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = loop.time() + self._flush_interval
+            stopping = False
+            while len(batch) < self._batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+            if stopping:
+                return
+
+    async def _flush(self, batch: List[Dict[str, Any]]) -> None:
+        for attempt in range(self._max_retries + 1):
+            try:
+                await self._insert_batch(batch)
+                logger.info(f"💾 {len(batch)} informe(s) guardado(s) en Supabase tabla informe_cadastro")
+                return
+            except Exception as e:
+                error = e
+                if not _is_retryable(e):
+                    break
+                if attempt < self._max_retries:
+                    logger.warning(f"⚠️ Insert de informes falló (intento {attempt + 1}), reintentando: {e}")
+                    await asyncio.sleep(self._retry_backoff * (2 ** attempt))
+        if len(batch) > 1 and not _is_retryable(error):
+            # El insert por array es todo-o-nada: se divide el lote para que solo
+            # las filas que violan el constraint terminen descartadas
+            logger.warning(f"⚠️ Lote de {len(batch)} informes rechazado ({error}), dividiendo para aislar las filas inválidas")
+            mid = len(batch) // 2
+            await self._flush(batch[:mid])
+            await self._flush(batch[mid:])
+            return
+        case_ids = [row.get("case_id") for row in batch]
+        logger.error(f"❌ Error guardando informes en Supabase (case_ids: {case_ids}): {error}")
+        logger.error("Sugerencia: Revisa la definición de la tabla 'informe_cadastro' en Supabase Studio y prueba un insert manual con los mismos datos para depurar el constraint.")
+        # Filas descartadas, registradas íntegras para poder reinsertarlas a mano
+        logger.error(f"[INFORME_DLQ] {orjson.dumps(batch).decode()}")
@@ -20,8 +20,21 @@ class PipefyService:
             client: Cliente de Pipefy (opcional, se crea uno nuevo si no se proporciona)
         """
         from src.integrations.pipefy_client import PipefyClient
+        # Solo se cierra en aclose() el cliente creado aquí; uno inyectado lo cierra su dueño
+        self._owns_client = client is None
         self.client = client or PipefyClient()
     
+    async def aclose(self) -> None:
+        """Libera el pool de conexiones del cliente de Pipefy, si lo creó este servicio."""
+        if self._owns_client:
+            await self.client.aclose()
+    
+    async def __aenter__(self) -> "PipefyService":
+        return self
+    
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+    
     async def process_triagem_result(
         self, 
         card_id: str, 
@@ -7,12 +7,15 @@ Solo hacen llamadas HTTP al backend que contiene toda la lógica de negocio.
 Cada herramienta es súper simple: recibe parámetros, llama al backend, devuelve respuesta.
 """
 
+import atexit
 import os
 import httpx
+import orjson
 import logging
 from typing import Dict, Any, Optional
 from crewai.tools import BaseTool
 from pydantic import BaseModel, Field
+from src.services.analysis_cache import TTLCache
 
 # Configuración de logging
 logger = logging.getLogger(__name__)
@@ -20,6 +23,21 @@ logger = logging.getLogger(__name__)
 # URL del backend (Document Ingestion Service)
 BACKEND_URL = os.getenv("DOCUMENT_INGESTION_URL", "https://pipefy-document-ingestion-modular.onrender.com")
 
+# Cliente HTTP compartido por todas las herramientas: reutiliza conexiones keep-alive
+# con el backend en vez de abrir TCP+TLS en cada llamada (httpx.Client es thread-safe)
+backend_http = httpx.Client(
+    base_url=BACKEND_URL,
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)
+)
+# Vive lo mismo que el proceso (las tools se importan una vez): se cierra al salir
+atexit.register(backend_http.close)
+
+# Caché corta de documentos por caso: el agente suele repetir la misma consulta
+# varias veces dentro de un mismo análisis
+DOCUMENTOS_CACHE_TTL = float(os.getenv("DOCUMENTOS_CACHE_TTL", "60"))
+_documentos_cache = TTLCache(maxsize=512, ttl=DOCUMENTOS_CACHE_TTL)
+
 class ObtenerDocumentosConContenidoAPITool(BaseTool):
     """
     HERRAMIENTA ULTRA-SIMPLE: Obtiene documentos con contenido parseado automáticamente
@@ -46,18 +64,23 @@ class ObtenerDocumentosConContenidoAPITool(BaseTool):
         Consulta la tabla documents que YA TIENE el contenido parseado.
         Ultra-simple: solo una consulta a Supabase.
         """
+        cache_key = f"{case_id}:{include_content}"
+        cached = _documentos_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"⚡ Documentos de case_id {case_id} servidos desde caché")
+            return cached
+        
         try:
             logger.info(f"📄 Obteniendo documentos con contenido para case_id: {case_id}")
             
             # Llamada HTTP simple al backend que consulta tabla documents
-            with httpx.Client(timeout=30.0) as client:
-                params = {"include_content": include_content}
-                response = client.get(
-                    f"{BACKEND_URL}/api/v1/documentos/{case_id}",
-                    params=params
-                )
-                response.raise_for_status()
-                result = response.json()
+            params = {"include_content": include_content}
+            response = backend_http.get(
+                f"/api/v1/documentos/{case_id}",
+                params=params
+            )
+            response.raise_for_status()
+            result = orjson.loads(response.content)
             
             if result.get("success"):
                 documents = result.get("documents", [])
@@ -71,21 +94,26 @@ class ObtenerDocumentosConContenidoAPITool(BaseTool):
                         parsing_status = doc.get('parsing_status', 'unknown')
                         
                         if parsing_status == 'completed':
-                            content_length = len(doc.get('parsed_content', ''))
+                            parsed_content = doc.get('parsed_content') or ''
+                            content_length = len(parsed_content)
                             confidence = doc.get('confidence_score', 0.0)
                             doc_summaries.append(
                                 f"- {name} ({doc_type}): ✅ {content_length} caracteres parseados (Confianza: {confidence:.2f})"
                             )
                             
                             # Si incluir contenido, añadirlo para análisis
-                            if include_content and doc.get('parsed_content'):
-                                doc_summaries.append(f"  CONTENIDO: {doc['parsed_content'][:500]}..." if len(doc['parsed_content']) > 500 else f"  CONTENIDO: {doc['parsed_content']}")
+                            # El slice ya acota a 500 (sin copia extra si el texto es más corto)
+                            if include_content and parsed_content:
+                                ellipsis = "..." if content_length > 500 else ""
+                                doc_summaries.append(f"  CONTENIDO: {parsed_content[:500]}{ellipsis}")
                         else:
                             doc_summaries.append(f"- {name} ({doc_type}): ❌ Parseo falló o pendiente")
                     
-                    return f"Documentos con contenido para {case_id}:\n" + "\n".join(doc_summaries)
-                else:
-                    return f"No se encontraron documentos para el case_id: {case_id}"
+                    resultado = f"Documentos con contenido para {case_id}:\n" + "\n".join(doc_summaries)
+                    _documentos_cache.set(cache_key, resultado)
+                    return resultado
+                # Sin caché: la ingestión puede estar todavía subiendo los documentos
+                return f"No se encontraron documentos para el case_id: {case_id}"
             else:
                 error_msg = f"Error al obtener documentos: {result.get('message', 'Error desconocido')}"
                 logger.error(error_msg)
@@ -143,13 +171,14 @@ class EnriquecerClienteAPITool(BaseTool):
             }
             
             # Llamada HTTP simple al backend
-            with httpx.Client(timeout=60.0) as client:
-                response = client.post(
-                    f"{BACKEND_URL}/api/v1/cliente/enriquecer",
-                    json=payload
-                )
-                response.raise_for_status()
-                result = response.json()
+            response = backend_http.post(
+                "/api/v1/cliente/enriquecer",
+                content=orjson.dumps(payload),
+                headers={"Content-Type": "application/json"},
+                timeout=60.0
+            )
+            response.raise_for_status()
+            result = orjson.loads(response.content)
             
             if result.get("success"):
                 logger.info(f"✅ Cliente enriquecido exitosamente: {cnpj}")
@@ -208,13 +237,13 @@ class NotificarWhatsAppAPITool(BaseTool):
             }
             
             # Llamada HTTP simple al backend
-            with httpx.Client(timeout=30.0) as client:
-                response = client.post(
-                    f"{BACKEND_URL}/api/v1/whatsapp/enviar",
-                    json=payload
-                )
-                response.raise_for_status()
-                result = response.json()
+            response = backend_http.post(
+                "/api/v1/whatsapp/enviar",
+                content=orjson.dumps(payload),
+                headers={"Content-Type": "application/json"}
+            )
+            response.raise_for_status()
+            result = orjson.loads(response.content)
             
             if result.get("success"):
                 logger.info(f"✅ WhatsApp enviado exitosamente para card: {card_id}")
@@ -273,13 +302,13 @@ class ActualizarPipefyAPITool(BaseTool):
             }
             
             # Llamada HTTP simple al backend
-            with httpx.Client(timeout=30.0) as client:
-                response = client.post(
-                    f"{BACKEND_URL}/api/v1/pipefy/actualizar",
-                    json=payload
-                )
-                response.raise_for_status()
-                result = response.json()
+            response = backend_http.post(
+                "/api/v1/pipefy/actualizar",
+                content=orjson.dumps(payload),
+                headers={"Content-Type": "application/json"}
+            )
+            response.raise_for_status()
+            result = orjson.loads(response.content)
             
             if result.get("success"):
                 logger.info(f"✅ Campo actualizado exitosamente en Pipefy: {card_id}")
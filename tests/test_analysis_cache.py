@@ -0,0 +1,80 @@
+"""
+Tests para el módulo analysis_cache.
+"""
+import pytest
+from src.services.analysis_cache import AnalysisCache, TTLCache
+
+@pytest.fixture
+def sample_documents():
+    """Fixture con documentos de ejemplo."""
+    return [
+        {
+            "name": "contrato_social.pdf",
+            "file_url": "https://example.com/contrato.pdf",
+            "document_tag": "contrato_social",
+            "parsed_content": "Contrato Social de la empresa..."
+        },
+        {
+            "name": "cartao_cnpj.pdf",
+            "file_url": "https://example.com/cnpj.pdf",
+            "document_tag": "cartao_cnpj",
+            "parsed_content": "Cartão CNPJ 11.222.333/0001-81"
+        }
+    ]
+
+class TestAnalysisCache:
+    """Tests para la clase AnalysisCache."""
+
+    def test_build_key_ignores_document_order(self, sample_documents):
+        """La clave no depende del orden de los documentos."""
+        key_a = AnalysisCache.build_key("123", None, sample_documents)
+        key_b = AnalysisCache.build_key("123", None, list(reversed(sample_documents)))
+        assert key_a == key_b
+
+    def test_build_key_changes_with_content(self, sample_documents):
+        """Cambiar el contenido parseado cambia la clave."""
+        key_a = AnalysisCache.build_key("123", None, sample_documents)
+        sample_documents[0]["parsed_content"] = "Otro contenido"
+        key_b = AnalysisCache.build_key("123", None, sample_documents)
+        assert key_a != key_b
+
+    def test_build_key_changes_with_cnpj(self, sample_documents):
+        """El cnpj del card forma parte de la clave (cambia el enriquecimiento del Cartão CNPJ)."""
+        key_sin_cnpj = AnalysisCache.build_key("123", None, sample_documents)
+        key_con_cnpj = AnalysisCache.build_key("123", None, sample_documents, "11.222.333/0001-81")
+        key_otro_cnpj = AnalysisCache.build_key("123", None, sample_documents, "99.888.777/0001-66")
+        assert len({key_sin_cnpj, key_con_cnpj, key_otro_cnpj}) == 3
+
+class TestTTLCache:
+    """Tests para la caché genérica TTLCache."""
+
+    def test_get_and_set(self):
+        """Un valor guardado se recupera hasta que expira."""
+        cache = TTLCache(maxsize=2, ttl=60)
+        assert cache.get("k") is None
+        cache.set("k", {"informe": "ok"})
+        assert cache.get("k") == {"informe": "ok"}
+
+    def test_expired_entries_are_dropped(self):
+        """Las entradas expiradas no se retornan."""
+        cache = TTLCache(maxsize=2, ttl=-1)
+        cache.set("k", {"informe": "ok"})
+        assert cache.get("k") is None
+
+    def test_evicts_least_recently_used(self):
+        """Al superar maxsize se descarta la entrada menos usada."""
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", {"v": 1})
+        cache.set("b", {"v": 2})
+        cache.get("a")
+        cache.set("c", {"v": 3})
+        assert cache.get("b") is None
+        assert cache.get("a") == {"v": 1}
+        assert cache.get("c") == {"v": 3}
+
+    def test_analysis_cache_is_a_ttl_cache(self):
+        """AnalysisCache solo añade build_key sobre la caché genérica."""
+        cache = AnalysisCache(maxsize=2, ttl=60)
+        assert isinstance(cache, TTLCache)
+        cache.set("k", {"informe": "ok"})
+        assert cache.get("k") == {"informe": "ok"}
@@ -0,0 +1,53 @@
+"""
+Tests para el módulo classification_service.
+"""
+import pytest
+from src.services.classification_service import ClassificationService, ClassificationType
+from src.services.faq_knowledge_service import faq_knowledge_service
+
+DOCUMENT_RULES = {
+    "contrato_social": {"required": True, "blocking_if_invalid": True},
+    "comprovante_endereco": {"required": True, "blocking_if_invalid": False, "required_fields": ["cep"]}
+}
+
+@pytest.fixture
+def service(monkeypatch):
+    """Servicio con reglas de documentos de ejemplo (sin leer el FAQ)."""
+    rules = {"documentos": DOCUMENT_RULES, "pendencias": {}, "acciones": {}}
+    monkeypatch.setattr(faq_knowledge_service, "extract_rules", lambda section: rules[section])
+    ClassificationService.invalidate_cache()
+    yield ClassificationService()
+    ClassificationService.invalidate_cache()
+
+class TestClassificationService:
+    """Tests para la clase ClassificationService."""
+
+    def test_all_documents_valid(self, service):
+        """Todos los documentos presentes y completos se aprueban."""
+        result = service.classify_documents({
+            "contrato_social": {"parsed_content": "Contrato"},
+            "comprovante_endereco": {"parsed_content": "Conta de luz", "cep": "01000-000"}
+        }, {}, "case-1")
+        assert result.classification_type == ClassificationType.APROVADO
+        assert result.confidence_score == 1.0
+        assert result.blocking_issues == [] and result.non_blocking_issues == []
+
+    def test_missing_blocking_document(self, service):
+        """La falta de un documento bloqueante genera pendencia bloqueante."""
+        result = service.classify_documents({
+            "comprovante_endereco": {"parsed_content": "Conta de luz", "cep": "01000-000"}
+        }, {}, "case-1")
+        assert result.classification_type == ClassificationType.PENDENCIA_BLOQUEANTE
+        assert len(result.blocking_issues) == 1
+        assert "contrato_social" in result.blocking_issues[0]
+        assert result.confidence_score == 0.75
+
+    def test_invalid_non_blocking_document(self, service):
+        """Un campo faltante en un documento no bloqueante genera pendencia no bloqueante."""
+        result = service.classify_documents({
+            "contrato_social": {"parsed_content": "Contrato"},
+            "comprovante_endereco": {"parsed_content": "Conta de luz"}
+        }, {}, "case-1")
+        assert result.classification_type == ClassificationType.PENDENCIA_NAO_BLOQUEANTE
+        assert result.blocking_issues == []
+        assert result.non_blocking_issues == ["Campo requerido 'cep' faltante en comprovante_endereco"]
@@ -0,0 +1,127 @@
+"""
+Tests para el módulo informe_writer.
+"""
+import asyncio
+import httpx
+from src.services.informe_writer import InformeBatchWriter
+
+def client_error(status_code: int = 400) -> httpx.HTTPStatusError:
+    """Error HTTP de PostgREST como el que lanza raise_for_status()."""
+    request = httpx.Request("POST", "https://example.supabase.co/rest/v1/informe_cadastro")
+    return httpx.HTTPStatusError("constraint", request=request, response=httpx.Response(status_code, request=request))
+
+class TestInformeBatchWriter:
+    """Tests para la clase InformeBatchWriter."""
+
+    def test_groups_rows_into_batches(self):
+        """Las filas encoladas se insertan en lotes de hasta batch_size."""
+        batches = []
+
+        async def insert_batch(rows):
+            batches.append(list(rows))
+
+        async def scenario():
+            writer = InformeBatchWriter(insert_batch, batch_size=2, flush_interval=5.0)
+            writer.start()
+            for i in range(5):
+                await writer.enqueue({"case_id": str(i)})
+            await writer.stop()
+
+        asyncio.run(scenario())
+        assert [len(batch) for batch in batches] == [2, 2, 1]
+        assert [row["case_id"] for batch in batches for row in batch] == ["0", "1", "2", "3", "4"]
+
+    def test_flushes_after_interval(self):
+        """Un lote incompleto se inserta al vencer flush_interval."""
+        batches = []
+
+        async def insert_batch(rows):
+            batches.append(list(rows))
+
+        async def scenario():
+            writer = InformeBatchWriter(insert_batch, batch_size=100, flush_interval=0.01)
+            writer.start()
+            await writer.enqueue({"case_id": "1"})
+            await asyncio.sleep(0.05)
+            assert len(batches) == 1
+            await writer.stop()
+
+        asyncio.run(scenario())
+        assert batches == [[{"case_id": "1"}]]
+
+    def test_insert_errors_do_not_stop_writer(self):
+        """Un fallo de insert se registra y el writer sigue procesando."""
+        batches = []
+
+        async def insert_batch(rows):
+            if rows[0]["case_id"] == "fail":
+                raise RuntimeError("constraint")
+            batches.append(list(rows))
+
+        async def scenario():
+            writer = InformeBatchWriter(insert_batch, batch_size=1, flush_interval=5.0, retry_backoff=0)
+            writer.start()
+            await writer.enqueue({"case_id": "fail"})
+            await writer.enqueue({"case_id": "ok"})
+            await writer.stop()
+
+        asyncio.run(scenario())
+        assert batches == [[{"case_id": "ok"}]]
+
+    def test_retries_failed_batches(self):
+        """Un fallo transitorio se reintenta antes de descartar el lote."""
+        attempts = []
+
+        async def insert_batch(rows):
+            attempts.append(list(rows))
+            if len(attempts) == 1:
+                raise httpx.ConnectTimeout("timeout")
+
+        async def scenario():
+            writer = InformeBatchWriter(insert_batch, batch_size=1, flush_interval=5.0, retry_backoff=0)
+            writer.start()
+            await writer.enqueue({"case_id": "1"})
+            await writer.stop()
+
+        asyncio.run(scenario())
+        assert attempts == [[{"case_id": "1"}], [{"case_id": "1"}]]
+
+    def test_enqueue_without_start_inserts_directly(self):
+        """Sin writer activo el informe se inserta en el momento."""
+        batches = []
+
+        async def insert_batch(rows):
+            batches.append(list(rows))
+
+        asyncio.run(InformeBatchWriter(insert_batch).enqueue({"case_id": "1"}))
+        assert batches == [[{"case_id": "1"}]]
+
+    def test_rejected_batch_isolates_invalid_rows(self):
+        """Un 4xx en un lote se divide hasta descartar solo la fila inválida."""
+        inserted = []
+
+        async def insert_batch(rows):
+            if any(row["case_id"] == "bad" for row in rows):
+                raise client_error()
+            inserted.extend(row["case_id"] for row in rows)
+
+        async def scenario():
+            writer = InformeBatchWriter(insert_batch, batch_size=5, flush_interval=5.0, retry_backoff=0)
+            writer.start()
+            for case_id in ["1", "2", "bad", "3", "4"]:
+                await writer.enqueue({"case_id": case_id})
+            await writer.stop()
+
+        asyncio.run(scenario())
+        assert sorted(inserted) == ["1", "2", "3", "4"]
+
+    def test_client_errors_are_not_retried(self):
+        """Un 4xx no se reintenta: la fila va directa al DLQ sin frenar la cola."""
+        attempts = []
+
+        async def insert_batch(rows):
+            attempts.append(list(rows))
+            raise client_error()
+
+        asyncio.run(InformeBatchWriter(insert_batch, retry_backoff=0).enqueue({"case_id": "1"}))
+        assert attempts == [[{"case_id": "1"}]]
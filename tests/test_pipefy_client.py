@@ -35,12 +35,12 @@ class TestPipefyClient:
     @pytest.mark.asyncio
     async def test_get_card_attachments_success(self, pipefy_client, mock_attachments_response):
         """Test obtención exitosa de documentos adjuntos."""
-        with patch('httpx.AsyncClient') as mock_client:
+        with patch.object(pipefy_client, "_get_client") as mock_get_client:
             mock_response = MagicMock()
             mock_response.json.return_value = mock_attachments_response
             mock_response.raise_for_status.return_value = None
             
-            mock_client.return_value.__aenter__.return_value.post = AsyncMock(return_value=mock_response)
+            mock_get_client.return_value.post = AsyncMock(return_value=mock_response)
             
             documents = await pipefy_client.get_card_attachments("123456")
             
@@ -56,12 +56,12 @@ class TestPipefyClient:
     @pytest.mark.asyncio
     async def test_get_card_attachments_no_attachments(self, pipefy_client):
         """Test cuando el card no tiene documentos adjuntos."""
-        with patch('httpx.AsyncClient') as mock_client:
+        with patch.object(pipefy_client, "_get_client") as mock_get_client:
             mock_response = MagicMock()
             mock_response.json.return_value = {"data": {"card": {"attachments": []}}}
             mock_response.raise_for_status.return_value = None
             
-            mock_client.return_value.__aenter__.return_value.post = AsyncMock(return_value=mock_response)
+            mock_get_client.return_value.post = AsyncMock(return_value=mock_response)
             
             documents = await pipefy_client.get_card_attachments("123456")
             assert len(documents) == 0
@@ -69,12 +69,12 @@ class TestPipefyClient:
     @pytest.mark.asyncio
     async def test_get_card_attachments_error(self, pipefy_client):
         """Test manejo de errores al obtener documentos adjuntos."""
-        with patch('httpx.AsyncClient') as mock_client:
+        with patch.object(pipefy_client, "_get_client") as mock_get_client:
             mock_response = MagicMock()
             mock_response.json.return_value = {"errors": ["Error de prueba"]}
             mock_response.raise_for_status.return_value = None
             
-            mock_client.return_value.__aenter__.return_value.post = AsyncMock(return_value=mock_response)
+            mock_get_client.return_value.post = AsyncMock(return_value=mock_response)
             
             with pytest.raises(PipefyAPIError, match="Error GraphQL al obtener adjuntos"):
                 await pipefy_client.get_card_attachments("123456")
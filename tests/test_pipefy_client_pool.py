@@ -0,0 +1,50 @@
+"""
+Tests para el ciclo de vida del cliente HTTP compartido de PipefyClient.
+"""
+import asyncio
+import httpx
+from unittest.mock import MagicMock, AsyncMock, patch
+from src.integrations.pipefy_client import PipefyClient
+
+PIPEFY_API_URL = "https://api.pipefy.com/graphql"
+
+class TestPipefyClientPool:
+    """Tests del pool de conexiones de PipefyClient."""
+
+    def test_reuses_pooled_client_until_closed(self):
+        """El cliente HTTP se crea una vez, se reutiliza y se cierra con aclose()."""
+        async def scenario():
+            client = PipefyClient(PIPEFY_API_URL, {}, 5)
+            http_client = client._get_client()
+            assert client._get_client() is http_client
+            await client.aclose()
+            assert http_client.is_closed
+
+        asyncio.run(scenario())
+
+    def test_async_with_keeps_injected_client_open(self):
+        """Un cliente inyectado lo cierra su dueño, no PipefyClient."""
+        async def scenario():
+            async with httpx.AsyncClient() as shared:
+                async with PipefyClient(PIPEFY_API_URL, {}, 5, client=shared) as client:
+                    assert client._get_client() is shared
+                assert not shared.is_closed
+
+        asyncio.run(scenario())
+
+    def test_queries_use_pooled_client(self):
+        """Las queries se envían por el cliente compartido."""
+        async def scenario():
+            client = PipefyClient(PIPEFY_API_URL, {}, 5)
+            response = MagicMock()
+            response.json.return_value = {"data": {"card": {"attachments": [
+                {"url": "https://example.com/doc1.pdf", "field": None, "filename": "doc1.pdf"}
+            ]}}}
+            with patch.object(client, "_get_client") as mock_get_client:
+                mock_get_client.return_value.post = AsyncMock(return_value=response)
+                documents = await client.get_card_attachments("123")
+            mock_get_client.return_value.post.assert_awaited_once()
+            return documents
+
+        documents = asyncio.run(scenario())
+        assert documents == [{"name": "doc1.pdf", "file_url": "https://example.com/doc1.pdf", "document_tag": ""}]
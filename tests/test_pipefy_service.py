@@ -105,4 +105,13 @@ async def test_update_card_informe_error(pipefy_service, mock_pipefy_client, sam
     with pytest.raises(Exception) as exc_info:
         await pipefy_service.update_card_informe("card_123", sample_analysis_result)
     
-    assert "Error inesperado" in str(exc_info.value) 
\ No newline at end of file
+    assert "Error inesperado" in str(exc_info.value) 
+
+
+@pytest.mark.asyncio
+async def test_aclose_keeps_injected_client_open(pipefy_service, mock_pipefy_client):
+    """Un cliente inyectado no se cierra al cerrar el servicio (lo cierra su dueño)."""
+    mock_pipefy_client.aclose = AsyncMock()
+    async with pipefy_service:
+        pass
+    mock_pipefy_client.aclose.assert_not_awaited()
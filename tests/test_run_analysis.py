@@ -0,0 +1,172 @@
+"""
+Tests para run_analysis (caché de resultados y concurrencia de /analyze).
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from fastapi import HTTPException
+import app
+from app import AnalysisRequest, run_analysis
+from src.services.analysis_cache import analysis_cache
+from src.services.classification_service import ClassificationResult, ClassificationType, classification_service
+from src.services.faq_knowledge_service import faq_knowledge_service
+
+@pytest.fixture
+def request_data():
+    """Request de análisis con un documento."""
+    return AnalysisRequest(
+        case_id="123",
+        cnpj="11.222.333/0001-81",
+        documents=[{
+            "name": "contrato_social.pdf",
+            "file_url": "https://example.com/contrato.pdf",
+            "document_tag": "contrato_social",
+            "parsed_content": "Contrato Social de la empresa..."
+        }]
+    )
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Sustituye validación, clasificación e informe; cuenta las ejecuciones de cada servicio."""
+    counters = {"validar": 0, "clasificar": 0, "llm_errors": False, "enrich_result": None}
+
+    def validate_documents(documentos):
+        counters["validar"] += 1
+        return {"status": "Aprovado", "logs": [], "detalles": {}, "acciones_automaticas": [], "llm_errors": counters["llm_errors"]}
+
+    def classify_documents(documents_data, card_data, case_id):
+        counters["clasificar"] += 1
+        auto_actions = []
+        if counters["enrich_result"] is not None:
+            auto_actions.append({"type": "GENERATE_DOCUMENT", "document_type": "cartao_cnpj", "enrich_result": counters["enrich_result"]})
+        return ClassificationResult(ClassificationType.APROVADO, [], [], [], 1.0, auto_actions, "ok")
+
+    async def enqueue(row):
+        pass
+
+    monkeypatch.setattr(faq_knowledge_service, "validate_documents", validate_documents)
+    monkeypatch.setattr(classification_service, "classify_documents", classify_documents)
+    monkeypatch.setattr(app.informe_writer, "enqueue", enqueue)
+    analysis_cache.clear()
+    yield counters
+    analysis_cache.clear()
+
+def run_twice(request_data):
+    async def scenario():
+        await run_analysis(request_data)
+        return await run_analysis(request_data)
+    return asyncio.run(scenario())
+
+class TestRunAnalysisCache:
+    """Solo los análisis completos se sirven desde la caché."""
+
+    def test_complete_analysis_is_cached(self, request_data, calls):
+        """Un análisis sin errores se reutiliza en el reintento."""
+        response = run_twice(request_data)
+        assert response["status"] == "completed"
+        assert calls["validar"] == 1 and calls["clasificar"] == 1
+
+    def test_llm_errors_are_not_cached(self, request_data, calls):
+        """Una validación con errores del LLM se repite en el reintento."""
+        calls["llm_errors"] = True
+        run_twice(request_data)
+        assert calls["validar"] == 2 and calls["clasificar"] == 2
+
+    def test_failed_enrichment_is_not_cached(self, request_data, calls):
+        """Un enriquecimiento del Cartão CNPJ fallido se repite en el reintento."""
+        calls["enrich_result"] = {"success": False, "error": "timeout"}
+        run_twice(request_data)
+        assert calls["validar"] == 2 and calls["clasificar"] == 2
+
+class TestRunAnalysisSlots:
+    """Un solo turno del semáforo por análisis, que cubre todo su trabajo en hilos."""
+
+    def test_analysis_takes_a_single_slot(self, request_data, calls, monkeypatch):
+        """Validación y clasificación comparten el turno del análisis."""
+        running = []
+
+        def validate_documents(documentos):
+            time.sleep(0.05)
+            running.append(app.analyses_running)
+            return {"status": "Aprovado", "logs": [], "detalles": {}, "acciones_automaticas": [], "llm_errors": False}
+
+        def classify_documents(documents_data, card_data, case_id):
+            time.sleep(0.05)
+            running.append(app.analyses_running)
+            return ClassificationResult(ClassificationType.APROVADO, [], [], [], 1.0, [], "ok")
+
+        monkeypatch.setattr(app, "analysis_semaphore", asyncio.Semaphore(2))
+        monkeypatch.setattr(faq_knowledge_service, "validate_documents", validate_documents)
+        monkeypatch.setattr(classification_service, "classify_documents", classify_documents)
+        asyncio.run(run_analysis(request_data))
+        assert running == [1, 1]
+        assert app.analyses_running == 0
+
+    def test_failed_validation_waits_for_classification(self, request_data, calls, monkeypatch):
+        """Si la validación falla, una clasificación ya en marcha conserva el turno hasta terminar."""
+        in_flight = []
+
+        def validate_documents(documentos):
+            time.sleep(0.05)
+            raise RuntimeError("LLM caído")
+
+        def classify_documents(documents_data, card_data, case_id):
+            in_flight.append(case_id)
+            time.sleep(0.1)
+            in_flight.remove(case_id)
+            return ClassificationResult(ClassificationType.APROVADO, [], [], [], 1.0, [], "ok")
+
+        monkeypatch.setattr(faq_knowledge_service, "validate_documents", validate_documents)
+        monkeypatch.setattr(classification_service, "classify_documents", classify_documents)
+
+        async def scenario():
+            with pytest.raises(HTTPException):
+                await run_analysis(request_data)
+            # Comprobado dentro del loop: asyncio.run esperaría al hilo al cerrar el executor
+            assert in_flight == []
+            assert app.analyses_running == 0
+
+        asyncio.run(scenario())
+
+    def test_failed_validation_skips_pending_classification(self, request_data, calls, monkeypatch):
+        """Si la validación falla antes de que arranque la clasificación, esta no se ejecuta."""
+        def validate_documents(documentos):
+            raise RuntimeError("LLM caído")
+
+        # Un solo hilo: la clasificación queda en cola detrás de la validación
+        executor = ThreadPoolExecutor(max_workers=1)
+        monkeypatch.setattr(app, "analysis_executor", executor)
+        monkeypatch.setattr(faq_knowledge_service, "validate_documents", validate_documents)
+        try:
+            with pytest.raises(HTTPException):
+                asyncio.run(run_analysis(request_data))
+        finally:
+            executor.shutdown()
+        assert calls["clasificar"] == 0
+
+    def test_admitted_analyses_are_never_rejected(self, request_data, calls, monkeypatch):
+        """Con cola limitada, los 503 llegan antes de la validación: ningún análisis admitido se rechaza."""
+        def validate_documents(documentos):
+            calls["validar"] += 1
+            time.sleep(0.05)
+            return {"status": "Aprovado", "logs": [], "detalles": {}, "acciones_automaticas": [], "llm_errors": False}
+
+        monkeypatch.setattr(app, "analysis_semaphore", asyncio.Semaphore(2))
+        monkeypatch.setattr(app, "MAX_QUEUED_ANALYSES", 1)
+        monkeypatch.setattr(faq_knowledge_service, "validate_documents", validate_documents)
+        requests = [request_data.model_copy(update={"case_id": str(i)}) for i in range(6)]
+
+        async def scenario():
+            return await asyncio.gather(*(run_analysis(r) for r in requests), return_exceptions=True)
+
+        results = asyncio.run(scenario())
+        completed = [r for r in results if isinstance(r, dict)]
+        rejected = [r for r in results if isinstance(r, HTTPException)]
+        assert len(completed) + len(rejected) == 6
+        assert all(r.status_code == 503 for r in rejected)
+        assert len(completed) == 3
+        # Cada validación ejecutada terminó en respuesta: ningún rechazo tras pagar el LLM
+        assert calls["validar"] == len(completed)
+        assert calls["clasificar"] == len(completed)
+        assert app.analyses_running == 0 and app.analyses_waiting == 0